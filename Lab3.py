@@ -1,3 +1,16 @@
+import argparse
+import atexit
+import json
+import mmap
+import os
+import sys
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from multiprocessing import shared_memory
+
 import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
 
@@ -9,7 +22,710 @@ Created on Wed Oct 31 19:27:26 2018
 """
 
 
+class Instrumentation:
+    # Opt-in counters for the tree hot paths and timing histograms for the
+    # load, build and query phases. Nothing is counted unless
+    # enable_instrumentation() has been called; until then the hooks cost one
+    # check of the module-level STATS per operation.
+    def __init__(self):
+        self.operations = {'insert': 0, 'search': 0, 'lookup_many': 0}
+        self.comparisons = {'insert': 0, 'search': 0, 'lookup_many': 0}
+        self.rotations = {'left': 0, 'right': 0}
+        self.recolorings = 0
+        self.rebalance_steps = 0
+        self.timings = {}
+
+        # How many timed blocks of each phase are open, so only the outermost
+        # one is recorded, and the seconds spent parsing inside a readFile
+        # generator, which the block consuming it leaves out of its own time.
+        self.open = {}
+        self.excluded = 0.0
+
+    def record(self, phase, seconds):
+        self.timings.setdefault(phase, []).append(seconds)
+
+    # Returns the timings of phase bucketed by powers of two microseconds, as
+    # a dict from each bucket's upper bound to its count.
+    def histogram(self, phase):
+
+        buckets = {}
+
+        for seconds in self.timings.get(phase, []):
+            bound = 1 << max(int(seconds * 1e6), 0).bit_length()
+            buckets[bound] = buckets.get(bound, 0) + 1
+
+        return dict(sorted(buckets.items()))
+
+    # Returns the counters and histograms as plain values, e.g. for JSON.
+    def summary(self):
+
+        return {
+            'operations': dict(self.operations),
+            'comparisons': dict(self.comparisons),
+            'rotations': dict(self.rotations),
+            'recolorings': self.recolorings,
+            'rebalance_steps': self.rebalance_steps,
+            'timings': {phase: {'runs': len(times), 'total_s': sum(times),
+                                'histogram_us': self.histogram(phase)}
+                        for phase, times in self.timings.items()},
+        }
+
+    def report(self):
+
+        lines = ['Instrumentation report']
+
+        for operation in ('insert', 'search'):
+            count = self.operations[operation]
+            per = self.comparisons[operation] / count if count else 0.0
+            lines.append('%-8s %10d calls %12d comparisons (%.2f per call)'
+                         % (operation, count, self.comparisons[operation], per))
+
+        lines.append('rotations: %d left, %d right' % (self.rotations['left'], self.rotations['right']))
+        lines.append('recolorings: %d' % self.recolorings)
+        lines.append('AVL rebalance steps: %d' % self.rebalance_steps)
+
+        for phase, times in self.timings.items():
+            lines.append('%-8s %6d runs %10.4fs total %10.6fs mean'
+                         % (phase, len(times), sum(times), sum(times) / len(times)))
+
+            for bound, count in self.histogram(phase).items():
+                lines.append('    <= %10d us: %d' % (bound, count))
+
+        return '\n'.join(lines)
+
+
+# The active Instrumentation, or None when instrumentation is off.
+STATS = None
+
+
+def enable_instrumentation():
+
+    global STATS
+    STATS = Instrumentation()
+
+    return STATS
+
+
+def disable_instrumentation():
+
+    global STATS
+    STATS = None
+
+
+# Records how long the body of the with block takes under phase, when
+# instrumentation is on. A block inside another block of the same phase is
+# not recorded, so a query that calls another timed query counts once, and
+# time spent parsing lines for readFile is left to the 'load' phase.
+@contextmanager
+def timed(phase):
+
+    stats = STATS
+
+    if stats is None or stats.open.get(phase):
+        yield
+        return
+
+    stats.open[phase] = 1
+    excluded = stats.excluded
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        stats.open[phase] = 0
+        stats.record(phase, time.perf_counter() - start - (stats.excluded - excluded))
+
+
+# Counts an insertion. The number of key comparisons made on the way down is
+# the depth the new node ended up at, so it is read off the parent links
+# rather than counted inside the insertion loop.
+def count_insert(node):
+
+    depth = 0
+    node = node.parent
+
+    while node is not None:
+        depth += 1
+        node = node.parent
+
+    STATS.operations['insert'] += 1
+    STATS.comparisons['insert'] += depth
+
+
+class EmbeddingStore:
+    # Keeps every vector in one contiguous float32 matrix. Tree nodes only hold
+    # the row index of their vector, the vector is parsed once when it is
+    # added, and lookups hand back a view of the matrix row instead of a copy.
+    def __init__(self, capacity=1024):
+        self.matrix = None
+        self.words = []
+        self.count = 0
+        self.capacity = capacity
+        self.norms = None
+
+    def __len__(self):
+        return self.count
+
+    # Appends a vector and returns its row index. The matrix doubles in size
+    # when it fills up, so the number of lines does not need to be known.
+    def add(self, word, vector):
+
+        if self.matrix is None:
+            self.matrix = np.empty((self.capacity, len(vector)), dtype=np.float32)
+
+        elif self.count == self.matrix.shape[0]:
+            grown = np.empty((2 * self.matrix.shape[0], self.matrix.shape[1]), dtype=np.float32)
+            grown[:self.count] = self.matrix[:self.count]
+            self.matrix = grown
+
+        self.matrix[self.count] = vector
+        self.words.append(word)
+        self.count += 1
+        self.norms = None
+
+        return self.count - 1
+
+    # Drops the unused rows left over from growing, once loading is done. The
+    # buffer is shrunk in place when nothing else refers to it, so the vectors
+    # are never held twice; if views of it are still alive NumPy refuses, and
+    # the rows are copied instead.
+    def trim(self):
+
+        if self.matrix is None or self.matrix.shape[0] == self.count:
+            return
+
+        try:
+            self.matrix.resize((self.count, self.matrix.shape[1]))
+        except ValueError:
+            self.matrix = self.matrix[:self.count].copy()
+
+    # Returns a zero-copy view of the vector stored at row, or None.
+    def get(self, row):
+
+        if row is None:
+            return None
+
+        return self.matrix[row]
+
+    # Returns the length of every row, with 0 replaced by 1. Only these
+    # count floats are kept, not a normalized copy of the matrix; they are
+    # computed on first use, block by block, and dropped when a vector is
+    # added.
+    def row_norms(self, block=65536):
+
+        if self.norms is None:
+            norms = np.empty(self.count, dtype=np.float32)
+
+            for start in range(0, self.count, block):
+                stop = min(start + block, self.count)
+                norms[start:stop] = np.linalg.norm(self.matrix[start:stop], axis=1)
+
+            norms[norms == 0] = 1
+            self.norms = norms
+
+        return self.norms
+
+    # Returns a new matrix with every row scaled to unit length, so a cosine
+    # similarity is just a dot product. It is not kept, so callers that only
+    # need some rows should use unit_rows.
+    def normalized(self):
+        return self.unit_rows(np.arange(self.count))
+
+    # Returns the unit-length vectors of the given rows. Only those rows of
+    # the matrix are read, so a memory-mapped snapshot stays mostly on disk.
+    def unit_rows(self, rows):
+
+        vectors = np.asarray(self.matrix[rows], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        norms[norms == 0] = 1
+
+        return vectors / norms
+
+    # Cosine similarity of each pair of rows (rows1[i], rows2[i]).
+    def pair_similarity(self, rows1, rows2):
+        return np.einsum('ij,ij->i', self.unit_rows(rows1), self.unit_rows(rows2))
+
+    # Cosine similarity of each unit-length query against rows start..stop.
+    def block_scores(self, queries, start, stop):
+
+        stop = min(stop, self.count)
+        return (queries @ self.matrix[start:stop].T) / self.row_norms()[start:stop]
+
+    # Number of values in each vector.
+    def dim(self):
+        return 0 if self.matrix is None else self.matrix.shape[1]
+
+
+class LazyStore:
+    # Stand-in for EmbeddingStore that keeps only each word and the byte
+    # offset of its line in the memory-mapped embedding file. A vector is
+    # parsed the first time its row is used and kept in an LRU cache of
+    # cache_size vectors, so building a tree costs time and memory in
+    # proportion to the vocabulary, not to the width of the vectors.
+    def __init__(self, filename, cache_size=100000):
+        self.filename = filename
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.words = []
+        self.offsets = np.empty(0, dtype=np.int64)
+        self.extra = []
+        self.unit = None
+        self.hits = 0
+        self.misses = 0
+
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(filename) else b''
+
+    @property
+    def count(self):
+        return len(self.words)
+
+    def __len__(self):
+        return len(self.words)
+
+    # Records the word and line offset of every line for which keep(word) is
+    # true, without parsing any numbers.
+    def scan(self, keep=None):
+
+        offsets = []
+        data = self.data
+        position = 0
+        size = len(data)
+
+        while position < size:
+            end = data.find(b'\n', position)
+            if end < 0:
+                end = size
+
+            space = data.find(b' ', position, end)
+            word = data[position:space if space >= 0 else end].decode('utf-8')
+
+            if word and (keep is None or keep(word)):
+                self.words.append(word)
+                offsets.append(position)
+
+            position = end + 1
+
+        self.offsets = np.array(offsets, dtype=np.int64)
+
+        return self
+
+    # Vectors added after the scan are kept in memory after the file's rows.
+    def add(self, word, vector):
+
+        self.extra.append(np.asarray(vector, dtype=np.float32))
+        self.words.append(word)
+        self.unit = None
+
+        return len(self.words) - 1
+
+    def trim(self):
+        pass
+
+    # Returns the vector at row, parsing its line on first use.
+    def get(self, row):
+
+        if row is None:
+            return None
+
+        if row >= len(self.offsets):
+            return self.extra[row - len(self.offsets)]
+
+        vector = self.cache.get(row)
+
+        if vector is not None:
+            self.hits += 1
+            self.cache.move_to_end(row)
+            return vector
+
+        self.misses += 1
+        start = int(self.offsets[row])
+        end = self.data.find(b'\n', start)
+        if end < 0:
+            end = len(self.data)
+
+        line = self.data[start:end].decode('utf-8')
+        vector = np.fromstring(line.partition(' ')[2], dtype=np.float32, sep=' ')
+
+        self.cache[row] = vector
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return vector
+
+    # Returns the unit-length vectors of the given rows, parsing only those.
+    def unit_rows(self, rows):
+
+        rows = np.asarray(rows).tolist()
+        if not rows:
+            return np.empty((0, self.dim()), dtype=np.float32)
+
+        vectors = np.array([self.get(row) for row in rows], dtype=np.float32)
+
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+
+        return vectors / norms
+
+    # Full-vocabulary searches such as nearest need every vector, so this
+    # parses them all once and keeps the normalized matrix.
+    def normalized(self):
+
+        if self.unit is None:
+            self.unit = self.unit_rows(np.arange(len(self.words)))
+
+        return self.unit
+
+    def pair_similarity(self, rows1, rows2):
+        return np.einsum('ij,ij->i', self.unit_rows(rows1), self.unit_rows(rows2))
+
+    def block_scores(self, queries, start, stop):
+        return queries @ self.normalized()[start:stop].T
+
+    def dim(self):
+        return len(self.get(0)) if self.words else 0
+
+
+class QuantizedStore:
+    # Compact copy of an EmbeddingStore's vectors, stored either as float16
+    # or as int8 with one float32 scale per vector (the largest absolute
+    # value over 127). That is a half or about a quarter of the float32
+    # matrix. Similarities are computed from the quantized rows block by block
+    # without rebuilding the float32 matrix.
+    def __init__(self, store, mode='int8', block=65536):
+        self.mode = mode
+        self.block = block
+        self.words = list(store.words)
+        matrix = np.asarray(store.matrix[:store.count], dtype=np.float32)
+
+        if mode not in ('float16', 'int8'):
+            raise ValueError('mode must be float16 or int8, not %r' % (mode,))
+
+        self.data, self.scales = self.encode(matrix)
+        self.norms = np.empty(len(matrix), dtype=np.float32)
+
+        for start in range(0, len(matrix), block):
+            self.norms[start:start + block] = np.linalg.norm(self.decode(start, start + block), axis=1)
+
+        self.norms[self.norms == 0] = 1
+
+    @property
+    def count(self):
+        return len(self.words)
+
+    def __len__(self):
+        return len(self.words)
+
+    # Returns the quantized rows of a float32 matrix and their scales.
+    def encode(self, matrix):
+
+        if self.mode == 'float16':
+            return matrix.astype(np.float16), np.ones(len(matrix), dtype=np.float32)
+
+        scales = np.abs(matrix).max(axis=1) / 127 if len(matrix) else np.ones(0, dtype=np.float32)
+        scales[scales == 0] = 1
+
+        return np.rint(matrix / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    # Returns rows start..stop (or the rows listed in index) as float32.
+    def decode(self, start=None, stop=None, index=None):
+
+        if index is None:
+            index = slice(start, self.count if stop is None else min(stop, self.count))
+
+        return self.data[index].astype(np.float32) * self.scales[index, None]
+
+    def nbytes(self):
+        return self.data.nbytes + self.scales.nbytes + self.norms.nbytes
+
+    # Appends a vector and returns its row index. The arrays double in size
+    # when they fill up, as in EmbeddingStore.add, so adding many words stays
+    # linear.
+    def add(self, word, vector):
+
+        row = self.count
+
+        if row == len(self.data):
+            capacity = max(2 * row, 1024)
+
+            for name in ('data', 'scales', 'norms'):
+                old = getattr(self, name)
+                grown = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+                grown[:row] = old[:row]
+                setattr(self, name, grown)
+
+        data, scales = self.encode(np.asarray(vector, dtype=np.float32).reshape(1, -1))
+        self.data[row] = data[0]
+        self.scales[row] = scales[0]
+        self.norms[row] = np.linalg.norm(self.decode(index=[row])[0]) or 1
+        self.words.append(word)
+
+        return row
+
+    # Drops the unused rows left over from growing.
+    def trim(self):
+
+        if len(self.data) != self.count:
+            self.data = self.data[:self.count].copy()
+            self.scales = self.scales[:self.count].copy()
+            self.norms = self.norms[:self.count].copy()
+
+    # Returns the dequantized vector at row.
+    def get(self, row):
+
+        if row is None:
+            return None
+
+        return self.decode(index=[row])[0]
+
+    def unit_rows(self, rows):
+
+        rows = np.asarray(rows)
+        return self.decode(index=rows) / self.norms[rows, None]
+
+    def normalized(self):
+        return self.unit_rows(np.arange(len(self.words)))
+
+    # Cosine similarity of each pair of rows, computed in blocks straight from
+    # the quantized values. For int8 the products of the raw values are exact
+    # in float32, and the scales and norms are applied once per pair.
+    def pair_similarity(self, rows1, rows2):
+
+        rows1 = np.asarray(rows1)
+        rows2 = np.asarray(rows2)
+        result = np.empty(len(rows1), dtype=np.float32)
+
+        for start in range(0, len(rows1), self.block):
+            a = rows1[start:start + self.block]
+            b = rows2[start:start + self.block]
+            dots = np.einsum('ij,ij->i', self.data[a].astype(np.float32), self.data[b].astype(np.float32))
+            result[start:start + self.block] = (dots * self.scales[a] * self.scales[b]
+                                                / (self.norms[a] * self.norms[b]))
+
+        return result
+
+    def block_scores(self, queries, start, stop):
+
+        stop = min(stop, self.count)
+        scores = queries @ self.data[start:stop].astype(np.float32).T
+        return scores * (self.scales[start:stop] / self.norms[start:stop])
+
+    def dim(self):
+        return self.data.shape[1]
+
+
+class SharedVocabulary:
+    # Word list kept in flat arrays so it can live in shared memory: the words
+    # in sorted order as one UTF-8 blob with the offset each word starts at,
+    # the row of each sorted word, and the sorted position of each row.
+    # Indexing by row gives the word back like a list does, and find does a
+    # binary search over the sorted words, so no dict or tree is needed.
+    def __init__(self, blob, offsets, rows, positions):
+        self.blob = blob
+        self.offsets = offsets
+        self.rows = rows
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.rows)
+
+    # Returns the word stored at row.
+    def __getitem__(self, row):
+
+        if not -len(self.rows) <= row < len(self.rows):
+            raise IndexError('row out of range')
+
+        return self.key(self.positions[row]).decode('utf-8')
+
+    # Returns the i-th word in sorted order as UTF-8 bytes, which sort the
+    # same way as the words themselves.
+    def key(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    # Returns the row of word, or -1 if it is not in the vocabulary.
+    def find(self, word):
+
+        key = word.encode('utf-8')
+        lo = 0
+        hi = len(self.rows)
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < len(self.rows) and self.key(lo) == key:
+            return int(self.rows[lo])
+
+        return -1
+
+
+class SharedStore:
+    # Read-only store whose float32 matrix, row norms and SharedVocabulary
+    # all sit in one multiprocessing.shared_memory block. One process creates
+    # it from another store and passes handle to worker processes, which
+    # attach to the same block without copying anything. Rows are normalized
+    # with the stored norms as they are used, the same way QuantizedStore
+    # does, so the block holds only one copy of the vectors. The owner must
+    # call unlink once every process has called close.
+    def __init__(self, shm, handle, owner=False):
+        self.shm = shm
+        self.handle = handle
+        self.owner = owner
+
+        arrays = {}
+
+        for name, dtype, shape, offset in SharedStore.layout(handle['count'], handle['dim'], handle['blob']):
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+
+        self.matrix = arrays['matrix']
+        self.norms = arrays['norms']
+        self.words = SharedVocabulary(arrays['blob'], arrays['offsets'], arrays['rows'], arrays['positions'])
+        self.count = handle['count']
+
+    def __len__(self):
+        return self.count
+
+    # Byte offset, dtype and shape of every array in the block, each aligned
+    # to 8 bytes.
+    @staticmethod
+    def layout(count, dim, blob):
+
+        sections = []
+        offset = 0
+
+        for name, dtype, shape in (('matrix', np.float32, (count, dim)), ('norms', np.float32, (count,)),
+                                   ('offsets', np.int64, (count + 1,)), ('rows', np.int64, (count,)),
+                                   ('positions', np.int64, (count,)), ('blob', np.uint8, (blob,))):
+            sections.append((name, dtype, shape, offset))
+            offset += -(-int(np.prod(shape)) * np.dtype(dtype).itemsize // 8) * 8
+
+        return sections
+
+    # Copies store's vectors and vocabulary into a new shared memory block and
+    # returns the owning SharedStore. The vectors are copied and their norms
+    # computed block rows at a time, so no second full matrix is made. A
+    # QuantizedStore is refused: sharing its vectors as float32 would undo
+    # the quantization.
+    @classmethod
+    def create(cls, store, block=65536):
+
+        if isinstance(store, QuantizedStore):
+            raise TypeError('a QuantizedStore cannot be shared as float32 vectors')
+
+        words = list(store.words)
+        order = sorted(range(len(words)), key=words.__getitem__)
+        encoded = [words[row].encode('utf-8') for row in order]
+        blob = b''.join(encoded)
+
+        handle = {'name': None, 'count': len(words), 'dim': store.dim(), 'blob': len(blob)}
+        offset = SharedStore.layout(handle['count'], handle['dim'], len(blob))[-1][3]
+        shm = shared_memory.SharedMemory(create=True, size=max(offset + len(blob), 1))
+        handle['name'] = shm.name
+
+        shared = cls(shm, handle, owner=True)
+
+        for start in range(0, len(words), block):
+            stop = min(start + block, len(words))
+
+            if hasattr(store, 'matrix'):
+                shared.matrix[start:stop] = store.matrix[start:stop]
+            else:
+                for row in range(start, stop):
+                    shared.matrix[row] = store.get(row)
+
+            shared.norms[start:stop] = np.linalg.norm(shared.matrix[start:stop], axis=1)
+
+        shared.norms[shared.norms == 0] = 1
+        shared.words.offsets[0] = 0
+        np.cumsum([len(word) for word in encoded], out=shared.words.offsets[1:])
+        shared.words.rows[:] = order
+        shared.words.positions[order] = np.arange(len(order))
+        shared.words.blob[:] = np.frombuffer(blob, dtype=np.uint8)
+
+        shared.protect()
+
+        return shared
+
+    # Attaches to the block described by handle, read-only.
+    @classmethod
+    def attach(cls, handle):
+
+        shared = cls(shared_memory.SharedMemory(name=handle['name']), handle)
+        shared.protect()
+
+        return shared
+
+    def protect(self):
+
+        for array in (self.matrix, self.norms, self.words.blob, self.words.offsets,
+                      self.words.rows, self.words.positions):
+            array.flags.writeable = False
+
+    # Drops this process's views of the block. Results computed from the
+    # store must be copied out before this is called.
+    def close(self):
+
+        self.matrix = self.norms = self.words = None
+        self.shm.close()
+
+    # Frees the block. Only the process that created it should call this.
+    def unlink(self):
+
+        if self.owner:
+            self.shm.unlink()
+
+    def lookup_many(self, words):
+        return np.array([self.words.find(word) for word in words], dtype=np.int64)
+
+    def add(self, word, vector):
+        raise TypeError('SharedStore is read-only')
+
+    def trim(self):
+        pass
+
+    def get(self, row):
+
+        if row is None:
+            return None
+
+        return self.matrix[row]
+
+    def unit_rows(self, rows):
+
+        rows = np.asarray(rows)
+        return self.matrix[rows] / self.norms[rows, None]
+
+    def normalized(self):
+        return self.matrix / self.norms[:, None]
+
+    def pair_similarity(self, rows1, rows2):
+
+        rows1 = np.asarray(rows1)
+        rows2 = np.asarray(rows2)
+        dots = np.einsum('ij,ij->i', self.matrix[rows1], self.matrix[rows2])
+
+        return dots / (self.norms[rows1] * self.norms[rows2])
+
+    def block_scores(self, queries, start, stop):
+        return (queries @ self.matrix[start:stop].T) / self.norms[start:stop]
+
+    def dim(self):
+        return self.matrix.shape[1]
+
+
 class Node:  # creates object with the set ID and next pointer
+    # The word itself is the key. Python compares strings lexicographically
+    # without any extra work, which gives every word a distinct place in the
+    # tree, unlike the old product-of-ord ordering where anagrams collided.
+    # __slots__ drops the per-node __dict__, which is most of a node's size.
+    # size is the number of nodes in the subtree rooted here, kept up to date
+    # together with height.
+    __slots__ = ('key', 'code', 'parent', 'left', 'right', 'height', 'size')
+
     def __init__(self, word, cd):
 
         self.key = word
@@ -18,6 +734,7 @@ class Node:  # creates object with the set ID and next pointer
         self.left = None
         self.right = None
         self.height = 0
+        self.size = 1
 
     def get_balance(self):
         # Get current height of left subtree, or -1 if None
@@ -35,22 +752,27 @@ class Node:  # creates object with the set ID and next pointer
         # Calculate the balance factor.
         return left_height - right_height
 
+    # Recomputes the node's height and subtree size from its children.
     def update_height(self):
 
-        # Get current height of left subtree, or -1 if None
+        # Get current height and size of left subtree, or -1 and 0 if None
         left_height = -1
+        size = 1
 
         if self.left is not None:
             left_height = self.left.height
+            size += self.left.size
 
-        # Get current height of right subtree, or -1 if None
+        # Get current height and size of right subtree, or -1 and 0 if None
         right_height = -1
 
         if self.right is not None:
             right_height = self.right.height
+            size += self.right.size
 
         # Assign self.height with calculated node height.
         self.height = max(left_height, right_height) + 1
+        self.size = size
 
     def set_child(self, which_child, child):
 
@@ -93,107 +815,338 @@ class Node:  # creates object with the set ID and next pointer
 
 
 class AVLTree:
-    # Constructor to create an empty AVLTree. There is only
-    # one data member, the tree's root Node, and it starts
-    # out as None.
-    def __init__(self):
+    # Constructor to create an empty AVLTree. The tree's root Node
+    # starts out as None, and store holds the vectors that the
+    # nodes' codes point into.
+    def __init__(self, store=None):
         self.root = None
 
-    # Performs a left rotation at the given node. Returns the
-    # new root of the subtree.
-    def rotate_left(self, node):
-        # Define a convenience pointer to the right child of the
-        # left child.
-        right_left_child = node.right.left
+        if store is None:
+            store = EmbeddingStore()
+        self.store = store
+        self.index = None
+        self.scorer = None
 
-        # Step 1 - the right child moves up to the node's position.
-        # This detaches node from the tree, but it will be reattached
-        # later.
+        # Dictionary from word to row for lookup_many, built on first use and
+        # dropped whenever the tree changes.
+        self.word_index = None
 
-        if node.parent is not None:
-            node.parent.replace_child(node, node.right)
+        # Counts changes to the tree, so caches can tell when they are stale.
+        self.version = 0
 
-        else:  # node is root
-            self.root = node.right
-            self.root.parent = None
+    def __len__(self):
+        if self.root is None:
+            return 0
+        return self.root.size
 
-        # Step 2 - the node becomes the left child of what used
-        # to be its right child, but is now its parent. This will
-        # detach right_left_child from the tree.
-        node.right.set_child('left', node)
+    # Called whenever nodes are added or removed, so that anything derived
+    # from the tree's contents is rebuilt.
+    def changed(self):
+        self.word_index = None
+        self.version += 1
 
-        # Step 3 - reattach right_left_child as the right child of node.
-        node.set_child('right', right_left_child)
+    # Returns the number of words in the tree that sort before key.
+    def rank(self, key):
+        return rank_bst(self.root, key)
 
-        return node.parent
+    # Returns the node holding the i-th smallest word, counting from 0.
+    def select(self, i):
+        return select_bst(self.root, i)
 
-    # Performs a right rotation at the given node. Returns the
-    # subtree's new root.
+    # Returns the row of each word in words as an array in the same order,
+    # with -1 for words that are not in the tree. With use_dict the rows come
+    # from a dictionary built once from the tree instead of a tree walk.
+    @timed('query')
+    def lookup_many(self, words, use_dict=False):
 
-    def rotate_right(self, node):
-        # Define a convenience pointer to the left child of the
-        # right child.
+        if not use_dict:
+            return lookup_many_bst(self.root, words)
 
-        left_right_child = node.left.right
+        if self.word_index is None:
+            self.word_index = {node.key: node.code for node in inorder(self.root)}
 
-        # Step 1 - the left child moves up to the node's position.
-        # This detaches node from the tree, but it will be reattached
-        # later.
+        # Dictionary lookups count as operations but make no key comparisons.
+        if STATS is not None:
+            STATS.operations['lookup_many'] += len(words)
 
-        if node.parent is not None:
-            node.parent.replace_child(node, node.left)
+        get = self.word_index.get
 
-        else:  # node is root
-            self.root = node.left
-            self.root.parent = None
+        return np.array([get(word, -1) for word in words], dtype=np.int64)
 
-        # Step 2 - the node becomes the right child of what used
-        # to be its left child, but is now its parent. This will
-        # detach left_right_child from the tree.
-        node.left.set_child('right', node)
+    # Yields, in order, the row indices of the words w with lo <= w < hi.
+    def range(self, lo=None, hi=None):
+        return range_bst(self.root, lo, hi)
 
-        # Step 3 - reattach left_right_child as the left child of node.
-        node.set_child('left', left_right_child)
+    # Yields, in order, the row indices of the words starting with p.
+    def prefix(self, p):
+        return prefix_bst(self.root, p)
 
-        return node.parent
+    # Returns an AVLTree over the same store with root as its root.
+    def subtree(self, root):
 
-    # Updates the given node's height and rebalances the subtree if
-    # the balancing factor is now -2 or +2. Rebalancing is done by
-    # performing a rotation. Returns the subtree's new root if
-    # a rotation occurred, or the node if no rebalancing was required.
-    def rebalance(self, node):
+        tree = AVLTree(self.store)
+        tree.root = detach(root)
 
-        # First update the height of this node.
-        node.update_height()
+        return tree
 
-        # Check for an imbalance.
-        if node.get_balance() == -2:
+    # Returns the root of a subtree holding left, node and right, where every
+    # word under left sorts before node.key and every word under right after
+    # it. If the two heights are within one, node goes on top. Otherwise node
+    # is hung from the inner spine of the taller subtree, in place of the
+    # first subtree no more than one taller than the shorter side, and the
+    # path above it is rebalanced. That costs time in proportion to the
+    # difference in height.
+    def join_nodes(self, left, node, right):
 
-            # The subtree is too big to the right.
-            if node.right.get_balance() == 1:
-                # Double rotation case. First do a right rotation
-                # on the right child.
-                self.rotate_right(node.right)
+        left_height = left.height if left is not None else -1
+        right_height = right.height if right is not None else -1
+        node.parent = None
 
-            # A left rotation will now make the subtree balanced.
-            return self.rotate_left(node)
+        if abs(left_height - right_height) <= 1:
+            node.set_child('left', detach(left))
+            node.set_child('right', detach(right))
+            return node
 
-        elif node.get_balance() == 2:
+        if left_height > right_height:
+            self.root = detach(left)
+            parent = left
+            current = left.right
 
-            # The subtree is too big to the left
-            if node.left.get_balance() == -1:
-                # Double rotation case. First do a left rotation
-                # on the left child.
-                self.rotate_left(node.left)
+            while current is not None and current.height > right_height + 1:
+                parent = current
+                current = current.right
 
-            # A right rotation will now make the subtree balanced.
+            node.set_child('left', current)
+            node.set_child('right', detach(right))
+            parent.set_child('right', node)
+
+        else:
+            self.root = detach(right)
+            parent = right
+            current = right.left
+
+            while current is not None and current.height > left_height + 1:
+                parent = current
+                current = current.left
+
+            node.set_child('right', current)
+            node.set_child('left', detach(left))
+            parent.set_child('left', node)
+
+        while parent is not None:
+            self.rebalance(parent)
+            parent = parent.parent
+
+        return self.root
+
+    # Moves every word of right into this tree, with key at row added
+    # between them. Every word here must sort before key and every word of
+    # right after it, and both trees must use the same store. right is left
+    # empty. Returns self, or None if the trees cannot be joined.
+    def join(self, key, row, right):
+
+        if right.store is not self.store:
+            print('Trees must share a store to be joined')
+            return None
+
+        if ((self.root is not None and select_bst(self.root, self.root.size - 1).key >= key) or
+                (right.root is not None and select_bst(right.root, 0).key <= key)):
+            print(key+' does not sort between the two trees')
+            return None
+
+        root, right.root = right.root, None
+        self.root = self.join_nodes(self.root, Node(key, row), root)
+        self.changed()
+        right.changed()
+
+        return self
+
+    # Splits the tree at key. Returns a tree with the words before key, the
+    # row of key or None if it is not in the tree, and a tree with the words
+    # after key. Both trees share this tree's store, and this tree is left
+    # empty.
+    def split(self, key):
+
+        root, self.root = self.root, None
+        left, found, right = split_bst(self, root, key)
+        self.root = None
+        self.changed()
+
+        return self.subtree(left), (found.code if found is not None else None), self.subtree(right)
+
+    # Adds every word of other that is not already in this tree, which may be
+    # of either kind and use another store. The new words are built into a
+    # balanced subtree and merged in with union_bst, instead of inserted one
+    # at a time. other is left as it was. Returns self.
+    def union(self, other):
+
+        items = merge_items(self, other)
+        root, self.root = self.root, None
+        self.root = union_bst(self, root, self.build_subtree(items, 0, len(items) - 1))
+        self.changed()
+
+        return self
+
+    # Removes every word that is also in other. Returns self.
+    def difference(self, other):
+
+        root, self.root = self.root, None
+
+        # Removing a tree from itself leaves nothing, and difference_bst could
+        # not split the same nodes it is walking.
+        if other is not self:
+            self.root = difference_bst(self, root, other.root)
+        self.changed()
+
+        return self
+
+    # Performs a left rotation at the given node. Returns the
+    # new root of the subtree.
+    def rotate_left(self, node):
+        if STATS is not None:
+            STATS.rotations['left'] += 1
+
+        # Define convenience pointers to the node's parent, its right
+        # child, and the left child of the right child.
+        parent = node.parent
+        right_child = node.right
+        right_left_child = right_child.left
+
+        # The steps go from the bottom of the subtree up, so every node's
+        # height and size are recomputed after its children are final.
+
+        # Step 1 - reattach right_left_child as the right child of node.
+        node.set_child('right', right_left_child)
+
+        # Step 2 - the node becomes the left child of what used
+        # to be its right child.
+        right_child.set_child('left', node)
+
+        # Step 3 - the right child moves up to the node's old position.
+        if parent is not None:
+            parent.replace_child(node, right_child)
+
+        else:  # node was root
+            self.root = right_child
+            self.root.parent = None
+
+        return node.parent
+
+    # Performs a right rotation at the given node. Returns the
+    # subtree's new root.
+
+    def rotate_right(self, node):
+        if STATS is not None:
+            STATS.rotations['right'] += 1
+
+        # Define convenience pointers to the node's parent, its left
+        # child, and the right child of the left child.
+        parent = node.parent
+        left_child = node.left
+        left_right_child = left_child.right
+
+        # Step 1 - reattach left_right_child as the left child of node.
+        node.set_child('left', left_right_child)
+
+        # Step 2 - the node becomes the right child of what used
+        # to be its left child.
+        left_child.set_child('right', node)
+
+        # Step 3 - the left child moves up to the node's old position.
+        if parent is not None:
+            parent.replace_child(node, left_child)
+
+        else:  # node was root
+            self.root = left_child
+            self.root.parent = None
+
+        return node.parent
+
+    # Updates the given node's height and rebalances the subtree if
+    # the balancing factor is now -2 or +2. Rebalancing is done by
+    # performing a rotation. Returns the subtree's new root if
+    # a rotation occurred, or the node if no rebalancing was required.
+    def rebalance(self, node):
+
+        if STATS is not None:
+            STATS.rebalance_steps += 1
+
+        # First update the height of this node.
+        node.update_height()
+
+        # Check for an imbalance.
+        if node.get_balance() == -2:
+
+            # The subtree is too big to the right.
+            if node.right.get_balance() == 1:
+                # Double rotation case. First do a right rotation
+                # on the right child.
+                self.rotate_right(node.right)
+
+            # A left rotation will now make the subtree balanced.
+            return self.rotate_left(node)
+
+        elif node.get_balance() == 2:
+
+            # The subtree is too big to the left
+            if node.left.get_balance() == -1:
+                # Double rotation case. First do a left rotation
+                # on the left child.
+                self.rotate_left(node.left)
+
+            # A right rotation will now make the subtree balanced.
             return self.rotate_right(node)
 
         # No imbalance, so just return the original node.
         return node
 
+    # Builds the tree from an iterable of (word, vector) pairs in one pass
+    # instead of inserting and rebalancing one word at a time. The words are
+    # sorted once and the tree is assembled bottom-up from the sorted list,
+    # taking the middle word of each range as the subtree root, so the result
+    # is perfectly balanced and no rotations are needed.
+    def bulk_load(self, pairs):
+
+        items = []
+
+        for word, vector in pairs:
+            items.append((word, self.store.add(word, vector)))
+
+        self.bulk_load_rows(items)
+
+    # Same as bulk_load for (word, row) pairs whose vectors are already in
+    # the store.
+    def bulk_load_rows(self, items):
+
+        items = sorted(items)
+
+        # Bulk loading only applies to an empty tree. Otherwise fall back to
+        # regular insertion so the existing nodes are kept.
+        if self.root is not None:
+            for word, row in items:
+                self.insert(Node(word, row))
+            return
+
+        self.root = self.build_subtree(items, 0, len(items) - 1)
+        self.changed()
+
+    # Returns the root of a balanced subtree holding items[lo..hi].
+    def build_subtree(self, items, lo, hi):
+
+        if lo > hi:
+            return None
+
+        mid = (lo + hi) // 2
+        node = Node(items[mid][0], items[mid][1])
+        node.set_child('left', self.build_subtree(items, lo, mid - 1))
+        node.set_child('right', self.build_subtree(items, mid + 1, hi))
+
+        return node
+
     def insert(self, node):
 
+        self.changed()
+
         # Special case: if the tree is empty, just set the root to
         # the new node.
 
@@ -201,24 +1154,17 @@ class AVLTree:
             self.root = node
             node.parent = None
 
+            if STATS is not None:
+                count_insert(node)
+
         else:
             # Step 1 - do a regular binary search tree insert.
             current_node = self.root
 
             while current_node is not None:
-                # Choose to go left or right
-                ascii1 = 1
-                ascii2 = 1
-
-                for i in range(len(node.key)):
-                    ascii1 = ascii1 * ord(node.key[i])
-
-                for i in range(len(current_node.key)):
-                    ascii2 = ascii2 * ord(current_node.key[i])
-                ascii1 = ascii1 / len(node.key)
-                ascii2 = ascii2 / len(current_node.key)
-
-                if ascii1 < ascii2:
+                # Choose to go left or right. Words are ordered
+                # lexicographically, so this is a single string comparison.
+                if node.key < current_node.key:
                     # Go left. If left child is None, insert the new
                     # node here.
 
@@ -244,6 +1190,9 @@ class AVLTree:
                         # Go right and do the loop again.
                         current_node = current_node.right
 
+            if STATS is not None:
+                count_insert(node)
+
             # Step 2 - Rebalance along a path from the new node's parent up
             # to the root.
 
@@ -253,547 +1202,2857 @@ class AVLTree:
                 self.rebalance(node)
                 node = node.parent
 
-    def remove_node(self, node):
-        # Base case:
-        if node is None:
-            return False
+    def remove_node(self, node):
+        # Base case:
+        if node is None:
+            return False
+
+        self.changed()
+
+        # Parent needed for rebalancing.
+        parent = node.parent
+
+        # Case 1: Internal node with 2 children
+        if node.left is not None and node.right is not None:
+            # Find successor
+
+            successor_node = node.right
+
+            while successor_node.left != None:
+                successor_node = successor_node.left
+
+            # Copy the value from the node
+            node.key = successor_node.key
+            node.code = successor_node.code
+
+            # Recursively remove successor
+            self.remove_node(successor_node)
+
+            # Nothing left to do since the recursive call will have rebalanced
+            return True
+
+        # Case 2: Root node (with 1 or 0 children)
+        elif node is self.root:
+
+            if node.left is not None:
+                self.root = node.left
+
+            else:
+                self.root = node.right
+
+            if self.root is not None:
+                self.root.parent = None
+
+            return True
+
+        # Case 3: Internal with left child only
+        elif node.left is not None:
+            parent.replace_child(node, node.left)
+
+        # Case 4: Internal with right child only OR leaf
+        else:
+            parent.replace_child(node, node.right)
+
+        # node is gone. Anything that was below node that has persisted is already correctly
+        # balanced, but ancestors of node may need rebalancing.
+        node = parent
+
+        while node is not None:
+            self.rebalance(node)
+            node = node.parent
+
+        return True
+
+
+class RBTNode:
+    # The color is kept as the boolean red rather than a "red"/"black" string,
+    # and __slots__ drops the per-node __dict__. size is the number of nodes in
+    # the subtree rooted here.
+    __slots__ = ('key', 'code', 'left', 'right', 'parent', 'height', 'size', 'red')
+
+    def __init__(self, key, cd, parent, is_red=False, left=None, right=None):
+        self.key = key
+        self.code = cd
+        self.left = left
+        self.right = right
+        self.parent = parent
+        self.height = 0
+        self.size = 1
+        self.red = is_red
+
+        if left is not None or right is not None:
+            self.update_height()
+
+    # Returns true if both child nodes are black. A child set to None is considered
+    # to be black.
+    def are_both_children_black(self):
+
+        if self.left != None and self.left.is_red():
+            return False
+
+        if self.right != None and self.right.is_red():
+            return False
+        return True
+
+    # Returns the number of nodes in this subtree.
+    def count(self):
+        return self.size
+
+    # Recomputes the node's height and subtree size from its children.
+    def update_height(self):
+
+        # Get current height and size of left subtree, or -1 and 0 if None
+        left_height = -1
+        size = 1
+
+        if self.left is not None:
+            left_height = self.left.height
+            size += self.left.size
+
+        # Get current height and size of right subtree, or -1 and 0 if None
+        right_height = -1
+
+        if self.right is not None:
+            right_height = self.right.height
+            size += self.right.size
+
+        # Assign self.height with calculated node height.
+        self.height = max(left_height, right_height) + 1
+        self.size = size
+
+    # Returns the grandparent of this node
+    def get_grandparent(self):
+
+        if self.parent is None:
+            return None
+
+        return self.parent.parent
+
+    # Gets this node's predecessor from the left child subtree
+    # Precondition: This node's left child is not None
+    def get_predecessor(self):
+
+        node = self.left
+
+        while node.right is not None:
+            node = node.right
+
+        return node
+
+    # Returns this node's sibling, or None if this node does not have a sibling
+    def get_sibling(self):
+
+        if self.parent is not None:
+
+            if self is self.parent.left:
+                return self.parent.right
+
+            return self.parent.left
+
+        return None
+
+    # Returns the uncle of this node
+    def get_uncle(self):
+
+        grandparent = self.get_grandparent()
+
+        if grandparent is None:
+            return None
+
+        if grandparent.left is self.parent:
+            return grandparent.right
+
+        return grandparent.left
+
+    # Returns True if this node is black, False otherwise
+    def is_black(self):
+
+        return not self.red
+
+    # Returns True if this node is red, False otherwise
+    def is_red(self):
+
+        return self.red
+
+    # Replaces one of this node's children with a new child
+    def replace_child(self, current_child, new_child):
+
+        if self.left is current_child:
+            return self.set_child("left", new_child)
+
+        elif self.right is current_child:
+            return self.set_child("right", new_child)
+
+        return False
+
+    # Sets either the left or right child of this node
+    def set_child(self, which_child, child):
+
+        if which_child != "left" and which_child != "right":
+            return False
+
+        if which_child == "left":
+            self.left = child
+        else:
+            self.right = child
+
+        if child is not None:
+            child.parent = self
+
+        self.update_height()
+        return True
+
+
+class RedBlackTree:
+    def __init__(self, store=None):
+        self.root = None
+
+        if store is None:
+            store = EmbeddingStore()
+        self.store = store
+        self.index = None
+        self.scorer = None
+
+        # Dictionary from word to row for lookup_many, built on first use and
+        # dropped whenever the tree changes.
+        self.word_index = None
+
+        # Counts changes to the tree, so caches can tell when they are stale.
+        self.version = 0
+
+    def __len__(self):
+        if self.root is None:
+            return 0
+        return self.root.size
+
+    # Called whenever nodes are added or removed, so that anything derived
+    # from the tree's contents is rebuilt.
+    def changed(self):
+        self.word_index = None
+        self.version += 1
+
+    # Returns the number of words in the tree that sort before key.
+    def rank(self, key):
+        return rank_bst(self.root, key)
+
+    # Returns the node holding the i-th smallest word, counting from 0.
+    def select(self, i):
+        return select_bst(self.root, i)
+
+    # Returns the row of each word in words as an array in the same order,
+    # with -1 for words that are not in the tree. With use_dict the rows come
+    # from a dictionary built once from the tree instead of a tree walk.
+    @timed('query')
+    def lookup_many(self, words, use_dict=False):
+
+        if not use_dict:
+            return lookup_many_bst(self.root, words)
+
+        if self.word_index is None:
+            self.word_index = {node.key: node.code for node in inorder(self.root)}
+
+        # Dictionary lookups count as operations but make no key comparisons.
+        if STATS is not None:
+            STATS.operations['lookup_many'] += len(words)
+
+        get = self.word_index.get
+
+        return np.array([get(word, -1) for word in words], dtype=np.int64)
+
+    # Yields, in order, the row indices of the words w with lo <= w < hi.
+    def range(self, lo=None, hi=None):
+        return range_bst(self.root, lo, hi)
+
+    # Yields, in order, the row indices of the words starting with p.
+    def prefix(self, p):
+        return prefix_bst(self.root, p)
+
+    # Returns a RedBlackTree over the same store with root as its root.
+    def subtree(self, root):
+
+        tree = RedBlackTree(self.store)
+        tree.root = detach(root)
+
+        if root is not None:
+            root.red = False
+
+        return tree
+
+    # Returns the root of a subtree holding left, node and right, where every
+    # word under left sorts before node.key and every word under right after
+    # it. Both roots are colored black first. If their black heights match,
+    # node goes on top, black. Otherwise node is colored red and hung from
+    # the inner spine of the subtree with the larger black height, in place
+    # of the first black node whose black height matches the other side, and
+    # insertion_balance fixes a red parent above it as after an insertion.
+    def join_nodes(self, left, node, right):
+
+        for root in (left, right):
+            if root is not None:
+                root.parent = None
+                root.red = False
+
+        left_black = black_height(left)
+        right_black = black_height(right)
+        node.parent = None
+
+        if left_black == right_black:
+            node.red = False
+            node.set_child('left', left)
+            node.set_child('right', right)
+            return node
+
+        node.red = True
+
+        if left_black > right_black:
+            self.root = left
+            parent = None
+            current = left
+            height = left_black
+
+            while current is not None and (current.red or height > right_black):
+                if not current.red:
+                    height -= 1
+                parent = current
+                current = current.right
+
+            node.set_child('left', current)
+            node.set_child('right', right)
+            parent.set_child('right', node)
+
+        else:
+            self.root = right
+            parent = None
+            current = right
+            height = right_black
+
+            while current is not None and (current.red or height > left_black):
+                if not current.red:
+                    height -= 1
+                parent = current
+                current = current.left
+
+            node.set_child('right', current)
+            node.set_child('left', left)
+            parent.set_child('left', node)
+
+        self.insertion_balance(node)
+
+        # As in insert_node, the rest of the path up to the root now has more
+        # nodes below it.
+        node = node.parent
+
+        while node is not None:
+            node.update_height()
+            node = node.parent
+
+        return self.root
+
+    # Moves every word of right into this tree, with key at row added
+    # between them. Every word here must sort before key and every word of
+    # right after it, and both trees must use the same store. right is left
+    # empty. Returns self, or None if the trees cannot be joined.
+    def join(self, key, row, right):
+
+        if right.store is not self.store:
+            print('Trees must share a store to be joined')
+            return None
+
+        if ((self.root is not None and select_bst(self.root, self.root.size - 1).key >= key) or
+                (right.root is not None and select_bst(right.root, 0).key <= key)):
+            print(key+' does not sort between the two trees')
+            return None
+
+        root, right.root = right.root, None
+        self.root = self.join_nodes(self.root, RBTNode(key, row, None), root)
+        self.root.red = False
+        self.changed()
+        right.changed()
+
+        return self
+
+    # Splits the tree at key. Returns a tree with the words before key, the
+    # row of key or None if it is not in the tree, and a tree with the words
+    # after key. Both trees share this tree's store, and this tree is left
+    # empty.
+    def split(self, key):
+
+        root, self.root = self.root, None
+        left, found, right = split_bst(self, root, key)
+        self.root = None
+        self.changed()
+
+        return self.subtree(left), (found.code if found is not None else None), self.subtree(right)
+
+    # Adds every word of other that is not already in this tree, which may be
+    # of either kind and use another store. The new words are built into a
+    # valid red-black subtree and merged in with union_bst, instead of
+    # inserted one at a time. other is left as it was. Returns self.
+    def union(self, other):
+
+        items = merge_items(self, other)
+        bottom = len(items).bit_length() - 1
+        added = self.build_subtree(items, 0, len(items) - 1, 0, bottom)
+
+        root, self.root = self.root, None
+        self.root = union_bst(self, root, added)
+
+        if self.root is not None:
+            self.root.red = False
+
+        self.changed()
+
+        return self
+
+    # Removes every word that is also in other. Returns self.
+    def difference(self, other):
+
+        root, self.root = self.root, None
+
+        # Removing a tree from itself leaves nothing, and difference_bst could
+        # not split the same nodes it is walking.
+        if other is not self:
+            self.root = difference_bst(self, root, other.root)
+
+        if self.root is not None:
+            self.root.red = False
+
+        self.changed()
+
+        return self
+
+    def insert(self, key, cd):
+
+        new_node = RBTNode(key, cd, None, True, None, None)
+
+        self.insert_node(new_node)
+
+    # Builds the tree from an iterable of (word, vector) pairs in one pass.
+    # The words are sorted once and the tree is assembled bottom-up from the
+    # sorted list. Every root-to-leaf path in that tree has the same length
+    # apart from the bottom level, so coloring the bottom level red and
+    # everything else black gives a valid red-black tree.
+    def bulk_load(self, pairs):
+
+        items = []
+
+        for word, vector in pairs:
+            items.append((word, self.store.add(word, vector)))
+
+        self.bulk_load_rows(items)
+
+    # Same as bulk_load for (word, row) pairs whose vectors are already in
+    # the store.
+    def bulk_load_rows(self, items):
+
+        items = sorted(items)
+
+        # Bulk loading only applies to an empty tree. Otherwise fall back to
+        # regular insertion so the existing nodes are kept.
+        if self.root is not None:
+            for word, row in items:
+                self.insert(word, row)
+            return
+
+        # Depth of the bottom level of a tree built by halving len(items).
+        bottom = len(items).bit_length() - 1
+
+        self.root = self.build_subtree(items, 0, len(items) - 1, 0, bottom)
+        self.changed()
+
+    # Returns the root of a balanced subtree holding items[lo..hi], where
+    # depth is the depth of that root in the finished tree.
+    def build_subtree(self, items, lo, hi, depth, bottom):
+
+        if lo > hi:
+            return None
+
+        mid = (lo + hi) // 2
+        node = RBTNode(items[mid][0], items[mid][1], None, depth == bottom and depth > 0)
+        node.set_child("left", self.build_subtree(items, lo, mid - 1, depth + 1, bottom))
+        node.set_child("right", self.build_subtree(items, mid + 1, hi, depth + 1, bottom))
+
+        return node
+
+
+    def insert_node(self, node):
+        self.changed()
+
+        # Begin with normal BST insertion
+        if self.root is None:
+            # Special case for root
+            self.root = node
+
+        else:
+
+            current_node = self.root
+
+            while current_node is not None:
+                if node.key < current_node.key:
+
+                    if current_node.left is None:
+                        current_node.set_child("left", node)
+                        break
+
+                    else:
+                        current_node = current_node.left
+
+                else:
+
+                    if current_node.right is None:
+                        current_node.set_child("right", node)
+                        break
+
+                    else:
+                        current_node = current_node.right
+
+        if STATS is not None:
+            count_insert(node)
+
+        # Color the node red
+        node.red = True
+
+        # Balance
+        self.insertion_balance(node)
+
+        # Every ancestor of the new node now has one more node below it, and
+        # may be taller. Rotations only fix up the nodes they move, so update
+        # the rest of the path up to the root.
+        node = node.parent
+
+        while node is not None:
+            node.update_height()
+            node = node.parent
+
+    def insertion_balance(self, node):
+
+        node.update_height()
+        # If node is the tree's root, then color node black and return
+
+        if node.parent is None:
+            if STATS is not None and node.red:
+                STATS.recolorings += 1
+            node.red = False
+            return
+
+        # If parent is black, then return without any alterations
+        if node.parent.is_black():
+            return
+
+        # References to parent, grandparent, and uncle are needed for remaining operations
+        parent = node.parent
+
+        grandparent = node.get_grandparent()
+
+        uncle = node.get_uncle()
+
+        # If parent and uncle are both red, then color parent and uncle black, color grandparent
+        # red, recursively balance  grandparent, then return
+        if uncle is not None and uncle.is_red():
+            parent.red = uncle.red = False
+            grandparent.red = True
+            if STATS is not None:
+                STATS.recolorings += 3
+            self.insertion_balance(grandparent)
+            return
+
+        # If node is parent's right child and parent is grandparent's left child, then rotate left
+        # at parent, update node and parent to point to parent and grandparent, respectively
+        if node is parent.right and parent is grandparent.left:
+            self.rotate_left(parent)
+            node = parent
+            parent = node.parent
+        # Else if node is parent's left child and parent is grandparent's right child, then rotate
+        # right at parent, update node and parent to point to parent and grandparent, respectively
+        elif node is parent.left and parent is grandparent.right:
+            self.rotate_right(parent)
+            node = parent
+            parent = node.parent
+
+        # Color parent black and grandparent red
+        parent.red = False
+        grandparent.red = True
+        if STATS is not None:
+            STATS.recolorings += 2
+
+        # If node is parent's left child, then rotate right at grandparent, otherwise rotate left
+        # at grandparent
+        if node is parent.left:
+            self.rotate_right(grandparent)
+        else:
+            self.rotate_left(grandparent)
+
+    # Rotations relink from the bottom up, so each node's height and size are
+    # recomputed only after its children are final.
+    def rotate_left(self, node):
+        if STATS is not None:
+            STATS.rotations['left'] += 1
+
+        parent = node.parent
+        right_child = node.right
+
+        node.set_child("right", right_child.left)
+        right_child.set_child("left", node)
+
+        if parent is not None:
+            parent.replace_child(node, right_child)
+
+        else:  # node was root
+            self.root = right_child
+            self.root.parent = None
+
+    def rotate_right(self, node):
+        if STATS is not None:
+            STATS.rotations['right'] += 1
+
+        parent = node.parent
+        left_child = node.left
+
+        node.set_child("left", left_child.right)
+        left_child.set_child("right", node)
+
+        if parent is not None:
+            parent.replace_child(node, left_child)
+
+        else:  # node was root
+            self.root = left_child
+            self.root.parent = None
+
+
+class LSHIndex:
+    # Approximate nearest-neighbour index over an EmbeddingStore using
+    # random-hyperplane hashing. Each of the n_tables tables hashes a vector
+    # to n_bits bits, one per hyperplane, set when the vector is on the
+    # positive side. Vectors pointing the same way tend to share a bucket, so
+    # a query only scores the rows in its own buckets instead of the whole
+    # matrix. More tables or probes raise recall, more bits make buckets
+    # smaller and queries faster.
+    def __init__(self, store, n_tables=8, n_bits=16, seed=0):
+        self.store = store
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.seed = seed
+        self.planes = None
+        self.codes = None
+        self.order = None
+
+    # Hashes every row of the store. For each table the rows are kept sorted
+    # by bucket code, so a bucket is a contiguous slice found by binary search.
+    def build(self, block=65536):
+
+        n = len(self.store)
+        rng = np.random.default_rng(self.seed)
+        self.planes = rng.standard_normal((self.n_tables, self.n_bits, self.store.dim())).astype(np.float32)
+        codes = np.empty((self.n_tables, n), dtype=np.int64)
+
+        # The rows are normalized a block at a time, so no normalized copy of
+        # the whole matrix is made.
+        for start in range(0, n, block):
+            unit = self.store.unit_rows(np.arange(start, min(start + block, n)))
+
+            for t in range(self.n_tables):
+                codes[t, start:start + len(unit)] = self.hash(t, unit @ self.planes[t].T)
+
+        self.order = np.argsort(codes, axis=1, kind='stable')
+        self.codes = np.take_along_axis(codes, self.order, axis=1)
+
+        return self
+
+    # Turns projections onto the hyperplanes of one table into bucket codes.
+    def hash(self, t, projections):
+
+        weights = np.left_shift(np.int64(1), np.arange(self.n_bits, dtype=np.int64))
+
+        return (projections > 0).astype(np.int64) @ weights
+
+    # Returns the rows sharing a bucket with vector. Besides the vector's own
+    # bucket, each table also probes the buckets reached by flipping the
+    # probes bits whose hyperplanes the vector lies closest to.
+    def candidates(self, vector, probes=0):
+
+        found = []
+
+        for t in range(self.n_tables):
+            projections = self.planes[t] @ vector
+            code = int(self.hash(t, projections))
+            buckets = [code]
+
+            for bit in np.argsort(np.abs(projections))[:probes]:
+                buckets.append(code ^ (1 << int(bit)))
+
+            for bucket in buckets:
+                lo = np.searchsorted(self.codes[t], bucket, side='left')
+                hi = np.searchsorted(self.codes[t], bucket, side='right')
+                found.append(self.order[t, lo:hi])
+
+        return np.unique(np.concatenate(found))
+
+    # Returns the k best (row, similarity) pairs for the row query, leaving
+    # the query row itself out. Only the candidate rows are normalized and
+    # scored, so stores that normalize on the fly never do the whole matrix.
+    def query(self, row, k=10, probes=0):
+
+        vector = self.store.unit_rows([row])[0]
+        rows = self.candidates(vector, probes)
+        rows = rows[rows != row]
+        scores = self.store.unit_rows(rows) @ vector
+
+        if len(rows) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            rows = rows[best]
+            scores = scores[best]
+
+        order = np.argsort(-scores, kind='stable')
+
+        return [(int(rows[i]), float(scores[i])) for i in order]
+
+    def save(self, path):
+
+        np.savez(path, planes=self.planes, codes=self.codes, order=self.order,
+                 settings=np.array([self.n_tables, self.n_bits, self.seed]))
+
+    # Loads an index written by save. store must hold the same vectors the
+    # index was built from.
+    @classmethod
+    def load(cls, path, store):
+
+        with np.load(path) as data:
+            n_tables, n_bits, seed = data['settings'].tolist()
+            index = cls(store, n_tables, n_bits, seed)
+            index.planes = data['planes']
+            index.codes = data['codes']
+            index.order = data['order']
+
+        return index
+
+
+class LookupCache:
+    # Bounded LRU cache in front of word lookups and pair similarities, for
+    # workloads where the same words and pairs keep coming back. It holds at
+    # most max_entries entries and, if max_bytes is given, about that many
+    # bytes; the least recently used entries are evicted first. (a, b) and
+    # (b, a) share one entry. The cache empties itself when the tree's
+    # version shows it was changed through insert or remove_node.
+    def __init__(self, tree, max_entries=100000, max_bytes=None):
+        self.tree = tree
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.version = tree.version
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    # Rough memory cost of an entry: the key tuple, its strings and the value.
+    def entry_size(self, key, value):
+        return sys.getsizeof(key) + sum(sys.getsizeof(part) for part in key) + sys.getsizeof(value)
+
+    # Returns (True, value) if key is cached, marking it most recently used,
+    # and (False, None) otherwise.
+    def get(self, key):
+
+        if self.tree.version != self.version:
+            self.clear()
+            self.version = self.tree.version
+
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return True, self.entries[key][0]
+
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value):
+
+        size = self.entry_size(key, value)
+        self.entries[key] = (value, size)
+        self.bytes += size
+
+        while self.entries and (len(self.entries) > self.max_entries or
+                                (self.max_bytes is not None and self.bytes > self.max_bytes)):
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.bytes -= evicted
+            self.evictions += 1
+
+    # Returns the row of word, or None if it is not in the tree.
+    def lookup(self, word):
+
+        key = ('word', word)
+        hit, row = self.get(key)
+
+        if not hit:
+            row = search_bst(self.tree.root, word)
+            self.put(key, row)
+
+        return row
+
+    # Returns the cosine similarity of two words, or None if either is not
+    # in the tree.
+    def similarity(self, word1, word2):
+
+        if word2 < word1:
+            word1, word2 = word2, word1
+
+        key = ('pair', word1, word2)
+        hit, score = self.get(key)
+
+        if not hit:
+            row1 = self.lookup(word1)
+            row2 = self.lookup(word2)
+            score = None
+
+            if row1 is not None and row2 is not None:
+                unit = self.tree.store.unit_rows([row1, row2])
+                score = float(unit[0] @ unit[1])
+
+            self.put(key, score)
+
+        return score
+
+    def stats(self):
+
+        return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+# Number of lines joined into each write when dumping a tree to a file.
+WRITE_CHUNK = 65536
+
+
+# Yields the nodes below node in ascending order. Uses an explicit stack, so
+# deep trees cannot hit the recursion limit.
+def inorder(node):
+
+    stack = []
+
+    while stack or node is not None:
+
+        while node is not None:
+            stack.append(node)
+            node = node.left
+
+        node = stack.pop()
+        yield node
+        node = node.right
+
+
+# Yields (node, depth) for the nodes below node one level at a time, left to
+# right within each level.
+def levelorder(node):
+
+    if node is None:
+        return
+
+    queue = deque([(node, 0)])
+
+    while queue:
+        node, depth = queue.popleft()
+        yield node, depth
+
+        if node.left is not None:
+            queue.append((node.left, depth + 1))
+        if node.right is not None:
+            queue.append((node.right, depth + 1))
+
+
+# Writes lines to f in large joined chunks instead of one write per line.
+def write_lines(f, lines):
+
+    chunk = []
+
+    for line in lines:
+        chunk.append(line)
+
+        if len(chunk) == WRITE_CHUNK:
+            f.write('\n'.join(chunk) + '\n')
+            chunk = []
+
+    if chunk:
+        f.write('\n'.join(chunk) + '\n')
+
+
+# Returns the dump line for node: the word, followed by its vector when a
+# store is given, in the same layout as the embedding file.
+def dump_line(node, store=None, layout=None):
+
+    if store is None:
+        return node.key
+
+    return node.key + ' ' + layout % tuple(store.get(node.code).tolist())
+
+
+# Writes the words below node to f in ascending order, one per line. With a
+# store each line also carries the word's vector.
+def pBST(node, f, store=None):
+
+    layout = None
+    if store is not None and len(store):
+        layout = ' '.join(['%.6g'] * store.dim())
+
+    write_lines(f, (dump_line(n, store, layout) for n in inorder(node)))
+
+
+# Returns the row of each word in words below node as an array in the same
+# order, with -1 for words that are not found. The words are sorted once and
+# resolved in a single walk: at each node the sorted batch is split with a
+# binary search into the words that go left, the ones that match and the ones
+# that go right, so shared parts of the search paths are walked only once.
+# While instrumentation is on, every word counts as a lookup_many operation
+# and each binary search as the most comparisons it can take.
+def lookup_many_bst(node, words):
+
+    stats = STATS
+
+    if stats is not None:
+        stats.operations['lookup_many'] += len(words)
+
+    order = sorted(range(len(words)), key=words.__getitem__)
+    keys = [words[i] for i in order]
+    rows = np.full(len(words), -1, dtype=np.int64)
+    stack = [(node, 0, len(keys))]
+
+    while stack:
+        node, lo, hi = stack.pop()
+
+        if node is None or lo >= hi:
+            continue
+
+        start = bisect_left(keys, node.key, lo, hi)
+        end = bisect_right(keys, node.key, start, hi)
+
+        if stats is not None:
+            stats.comparisons['lookup_many'] += (hi - lo).bit_length() + (hi - start).bit_length()
+
+        for j in range(start, end):
+            rows[order[j]] = node.code
+
+        stack.append((node.left, lo, start))
+        stack.append((node.right, end, hi))
+
+    return rows
+
+
+# Yields, in ascending order, the nodes below node whose words w satisfy
+# lo <= w < hi. A bound of None is open. The path down to lo is walked once,
+# and from there the walk is an ordinary in-order traversal that stops at hi.
+def range_nodes(node, lo=None, hi=None):
+
+    stack = []
+
+    while node is not None:
+
+        if lo is None or not node.key < lo:
+            stack.append(node)
+            node = node.left
+
+        else:
+            node = node.right
+
+    while stack:
+        node = stack.pop()
+
+        if hi is not None and not node.key < hi:
+            return
+
+        yield node
+
+        node = node.right
+
+        while node is not None:
+            stack.append(node)
+            node = node.left
+
+
+# Yields the row indices of the words w below node with lo <= w < hi, in
+# order, so the result can index the embedding matrix directly.
+def range_bst(node, lo=None, hi=None):
+
+    for other in range_nodes(node, lo, hi):
+        yield other.code
+
+
+# Yields the row indices of the words below node that start with p, in order.
+# Those words are contiguous in the tree starting at p itself.
+def prefix_bst(node, p):
+
+    for other in range_nodes(node, p):
+
+        if not other.key.startswith(p):
+            return
+
+        yield other.code
+
+
+# Every node knows the size of its subtree, so this no longer walks the tree.
+def numNodes(node):
+
+    if node is None:
+        return 0
+    return node.size
+
+
+# Returns the number of words below node that sort before key. Each step
+# down to the right skips the whole left subtree and the node itself.
+def rank_bst(node, key):
+
+    rank = 0
+
+    while node is not None:
+
+        if node.key < key:
+            rank += 1
+            if node.left is not None:
+                rank += node.left.size
+            node = node.right
+
+        else:
+            node = node.left
+
+    return rank
+
+
+# Returns the node holding the i-th smallest word below node, counting from
+# 0, or None if i is out of range.
+def select_bst(node, i):
+
+    if node is None or i < 0 or i >= node.size:
+        return None
+
+    while node is not None:
+        left_size = node.left.size if node.left is not None else 0
+
+        if i < left_size:
+            node = node.left
+
+        elif i == left_size:
+            return node
+
+        else:
+            i -= left_size + 1
+            node = node.right
+
+    return None
+
+
+# Join, split, union and difference work on detached subtrees given by their
+# roots. tree is only used for its join_nodes, which joins two subtrees
+# around a middle node and does the balancing for that kind of tree.
+
+
+# Clears node's parent link, so it can be used as the root of a subtree.
+def detach(node):
+
+    if node is not None:
+        node.parent = None
+
+    return node
+
+
+# Number of black nodes on any path from node down to a leaf, counting node.
+def black_height(node):
+
+    height = 0
+
+    while node is not None:
+        if not node.red:
+            height += 1
+        node = node.left
+
+    return height
+
+
+# Splits the subtree at node into the subtree of the words before key and
+# the subtree of the words after it. Returns (left root, the node holding key
+# or None, right root). The subtrees hanging off the search path for key are
+# joined back together on the way up, so this takes O(log n) joins.
+def split_bst(tree, node, key):
+
+    if node is None:
+        return None, None, None
+
+    left = detach(node.left)
+    right = detach(node.right)
+
+    if key < node.key:
+        lower, found, upper = split_bst(tree, left, key)
+        return lower, found, tree.join_nodes(upper, node, right)
+
+    if node.key < key:
+        lower, found, upper = split_bst(tree, right, key)
+        return tree.join_nodes(left, node, lower), found, upper
+
+    node.left = node.right = None
+    node.update_height()
+
+    return left, node, right
+
+
+# Joins the subtrees at left and right, where every word of left sorts before
+# every word of right, by taking the smallest node out of right to put
+# between them.
+def join_bst(tree, left, right):
+
+    if left is None:
+        return right
+
+    if right is None:
+        return left
+
+    first = right
+    while first.left is not None:
+        first = first.left
+
+    _, middle, rest = split_bst(tree, right, first.key)
+
+    return tree.join_nodes(left, middle, rest)
+
+
+# Returns the root of a subtree holding the words of the subtrees at a and b.
+# a is split at b's root and each half is merged with one of b's children,
+# which takes O(m log(n/m + 1)) for the m words of b and n words of a. For a
+# word in both, a's node is kept. Both subtrees are taken apart.
+def union_bst(tree, a, b):
+
+    if a is None:
+        return b
+
+    if b is None:
+        return a
+
+    b_left = detach(b.left)
+    b_right = detach(b.right)
+    lower, found, upper = split_bst(tree, a, b.key)
+
+    left = union_bst(tree, lower, b_left)
+    right = union_bst(tree, upper, b_right)
+
+    return tree.join_nodes(left, found if found is not None else b, right)
+
+
+# Returns the root of a subtree holding the words of the subtree at a that
+# are not under b. The subtree at b is only read.
+def difference_bst(tree, a, b):
+
+    if a is None or b is None:
+        return a
+
+    lower, _, upper = split_bst(tree, a, b.key)
+
+    return join_bst(tree, difference_bst(tree, lower, b.left), difference_bst(tree, upper, b.right))
+
+
+# Returns, sorted, the (word, row) pairs of the words of other that are not
+# in tree, with rows that point into tree's store. If other keeps its
+# vectors in a different store, such as a shard built in another process,
+# each new word's vector is copied into tree's store and gets a new row.
+def merge_items(tree, other):
+
+    nodes = list(inorder(other.root))
+    present = lookup_many_bst(tree.root, [node.key for node in nodes])
+    items = []
+
+    for node, row in zip(nodes, present.tolist()):
+
+        if row >= 0:
+            continue
+
+        if other.store is tree.store:
+            items.append((node.key, node.code))
+        else:
+            items.append((node.key, tree.store.add(node.key, other.store.get(node.code))))
+
+    return items
+
+
+# Returns the words at depth num below node, left to right. The level-order
+# walk reaches depth num after every shallower node, and stops as soon as it
+# goes past it.
+def words_at_depth(node, num):
+
+    found = []
+
+    for other, depth in levelorder(node):
+
+        if depth > num:
+            break
+
+        if depth == num:
+            found.append(other.key)
+
+    return found
+
+
+def patdepth(node, f, num):
+
+    if node is None:
+        return
+
+    if num > node.height:
+        print('BST does not have that depth')
+        return
+
+    write_lines(f, words_at_depth(node, num))
+
+
+def calculate_similarity(vector1, vector2):
+
+    if vector1 is None or vector2 is None:
+        print('Cannot proceed with an empty set.')
+        return None
+
+    # The vectors are already float32 rows of the embedding matrix, so they
+    # are only reshaped here, never copied or re-parsed.
+    array1 = np.asarray(vector1).reshape(1,-1)
+    array2 = np.asarray(vector2).reshape(1,-1)
+
+    return cosine_similarity(array1,array2)
+
+
+
+# Streams the embedding file one line at a time instead of reading it into a
+# list of strings. Each line is parsed once into (word, float32 vector) and
+# handed straight to the caller, so nothing but the tree itself is kept around.
+# Progress is printed every report_every lines as lines/sec.
+def readFile(a, report_every=100000):
+
+    start = time.perf_counter()
+    count = 0
+    stats = STATS
+    parsing = 0.0
+
+    with open(a, encoding='utf-8') as f:
+
+        for line in f:
+            if stats is not None:
+                parsed = time.perf_counter()
+
+            word, _, rest = line.rstrip('\n').partition(' ')
+            vector = np.fromstring(rest, dtype=np.float32, sep=' ')
+
+            # The time spent here is parsing; the time spent suspended at the
+            # yield belongs to whoever consumes the pairs.
+            if stats is not None:
+                parsing += time.perf_counter() - parsed
+
+            yield word, vector
+            count += 1
+
+            if report_every and count % report_every == 0:
+                elapsed = time.perf_counter() - start
+                print('Loaded %d lines (%.0f lines/sec)' % (count, count / elapsed))
+
+    elapsed = time.perf_counter() - start
+    if count and elapsed > 0:
+        print('Finished loading %d lines in %.2fs (%.0f lines/sec)' % (count, elapsed, count / elapsed))
+
+    # Parsing is recorded as one 'load' run and left out of the enclosing
+    # 'build' block, so the two phases do not overlap.
+    if stats is not None:
+        stats.record('load', parsing)
+        stats.excluded += parsing
+
+
+# Splits the file into about chunks byte ranges of similar size. Each range
+# but the last is extended to the end of the line it falls in, so no line is
+# ever cut in two.
+def chunk_ranges(a, chunks):
+
+    size = os.path.getsize(a)
+    bounds = [0]
+
+    with open(a, 'rb') as f:
+
+        for i in range(1, chunks):
+            f.seek(size * i // chunks)
+            f.readline()
+            position = f.tell()
+
+            if bounds[-1] < position < size:
+                bounds.append(position)
+
+    bounds.append(size)
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+# Parses the lines in bytes start..end of the file into a list of words and a
+# float32 block holding their vectors, one row per word. Runs in a worker
+# process, so it only takes and returns plain picklable values. Lines are
+# split on b'\n' only, as readFile does, since str.splitlines would also
+# break words holding characters such as \x85 or \u2028.
+def parse_chunk(a, start, end):
+
+    with open(a, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).split(b'\n')
+
+    if lines and not lines[-1]:
+        lines.pop()
+
+    words = []
+    width = None
+
+    # Each line is replaced by the values part of it as soon as its word is
+    # taken, so the chunk is not held twice.
+    for i, line in enumerate(lines):
+        word, _, rest = line.rstrip(b'\r').partition(b' ')
+        words.append(word.decode('utf-8'))
+        lines[i] = rest
+
+        if width is None:
+            width = len(rest.split())
+
+        elif len(rest.split()) != width:
+            raise ValueError('line %r has %d values, expected %d' % (words[-1], len(rest.split()), width))
+
+    if not words:
+        return words, np.empty((0, 0), dtype=np.float32)
+
+    # Every line has the same number of values, so the whole chunk can be
+    # converted with a single call and reshaped.
+    values = np.fromstring(b' '.join(lines), dtype=np.float32, sep=' ')
+
+    return words, values.reshape(len(words), width)
+
+
+# Parses the file in workers processes, each handling one line-aligned byte
+# range, and returns the vocabulary and one float32 matrix in file order. The
+# result is the same as reading the file with readFile, just faster.
+@timed('load')
+def readFileParallel(a, workers=None):
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    start = time.perf_counter()
+    ranges = chunk_ranges(a, workers)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parts = list(pool.map(parse_chunk, [a] * len(ranges),
+                              [lo for lo, _ in ranges], [hi for _, hi in ranges]))
+
+    words = []
+    for part, _ in parts:
+        words.extend(part)
+
+    # The blocks are copied into one preallocated matrix and each is let go
+    # as soon as it is copied, instead of concatenating them all at once.
+    dim = max(block.shape[1] for _, block in parts)
+    matrix = np.empty((len(words), dim), dtype=np.float32)
+    row = 0
+
+    for i, (_, block) in enumerate(parts):
+        if len(block) and block.shape[1] != dim:
+            raise ValueError('%s has vectors of %d and %d values' % (a, block.shape[1], dim))
+
+        matrix[row:row + len(block)] = block
+        row += len(block)
+        parts[i] = None
+
+    elapsed = time.perf_counter() - start
+    if words and elapsed > 0:
+        print('Finished loading %d lines in %.2fs with %d workers (%.0f lines/sec)'
+              % (len(words), elapsed, workers, len(words) / elapsed))
+
+    return words, matrix
+
+# Returns the row index stored for key, or None if the word is not in the
+# tree. Words are ordered lexicographically, the same as on insertion.
+def search_bst(node, key):
+
+    if STATS is not None:
+        return search_bst_counted(node, key)
+
+    temp = node
+
+    while temp is not None:
+
+        if temp.key == key:
+            return temp.code
+
+        elif temp.key < key:
+            temp = temp.right
+
+        else:
+            temp = temp.left
+
+
+# search_bst with the number of key comparisons recorded, used instead of it
+# while instrumentation is on.
+def search_bst_counted(node, key):
+
+    STATS.operations['search'] += 1
+    temp = node
+
+    while temp is not None:
+        STATS.comparisons['search'] += 1
+
+        if temp.key == key:
+            return temp.code
+
+        elif temp.key < key:
+            temp = temp.right
+
+        else:
+            temp = temp.left
+
+
+# Cosine similarity of every pair of rows (rows1[i], rows2[i]), computed by
+# the store in one vectorized pass.
+def batch_similarity(store, rows1, rows2):
+
+    return store.pair_similarity(rows1, rows2)
+
+
+# Returns the k closest words by cosine similarity to each of the query words.
+# words can be a single word or a list of them; for a list the result is one
+# list of (word, similarity) per query, in the same order, with None for words
+# that are not in the tree. The query words are found with search_bst and then
+# scored against the normalized matrix block by block, keeping only the best
+# k+1 candidates of every block with argpartition so the full score matrix is
+# never held in memory at once, up to batch query words at a time. If an
+# LSHIndex is given, only the rows in the query's buckets are scored instead
+# and the result is approximate.
+@timed('query')
+def nearest(tree, words, k=10, block=65536, index=None, probes=2, batch=256):
+
+    single = isinstance(words, str)
+
+    if single:
+        words = [words]
+
+    rows = [search_bst(tree.root, word) for word in words]
+    results = [None] * len(words)
+    found = [i for i in range(len(words)) if rows[i] is not None]
+
+    for i in range(len(words)):
+        if rows[i] is None:
+            print(words[i]+' is not in the tree')
+
+    if found and k > 0 and index is not None:
+        for i in found:
+            results[i] = [(tree.store.words[row], score)
+                          for row, score in index.query(rows[i], k, probes)]
+
+    elif found and k > 0:
+        # One extra candidate per block, since each query word is its own
+        # closest match and is dropped below.
+        keep = k + 1
+
+        for first in range(0, len(found), batch):
+            part = found[first:first + batch]
+            queries = tree.store.unit_rows([rows[i] for i in part])
+            cand_rows = []
+            cand_scores = []
+
+            for start in range(0, len(tree.store), block):
+                # Negated in place, so argpartition finds the best scores
+                # without a second score matrix.
+                scores = tree.store.block_scores(queries, start, start + block)
+                np.negative(scores, out=scores)
+                kb = min(keep, scores.shape[1])
+                top = np.argpartition(scores, kb - 1, axis=1)[:, :kb]
+
+                cand_rows.append(top + start)
+                cand_scores.append(-np.take_along_axis(scores, top, axis=1))
+
+            cand_rows = np.hstack(cand_rows)
+            cand_scores = np.hstack(cand_scores)
+            order = np.argsort(-cand_scores, axis=1, kind='stable')
+
+            for j, i in enumerate(part):
+                best = []
+
+                for o in order[j]:
+                    row = cand_rows[j, o]
+
+                    if row == rows[i]:
+                        continue
+
+                    best.append((tree.store.words[row], float(cand_scores[j, o])))
+
+                    if len(best) == k:
+                        break
+
+                results[i] = best
+
+    elif found:
+        for i in found:
+            results[i] = []
+
+    if single:
+        return results[0]
+
+    return results
+
+
+# Compares an LSHIndex against the exact search for sample query words and
+# prints recall@k (the share of the true k nearest words the index also
+# returns) and the average time per query of both. If words is not given,
+# samples rows are picked at random. Returns the numbers as a dict.
+def lsh_recall(tree, index, words=None, k=10, samples=100, probes=2, seed=0):
+
+    if words is None:
+        rng = np.random.default_rng(seed)
+        picked = rng.choice(len(tree.store), size=min(samples, len(tree.store)), replace=False)
+        words = [tree.store.words[row] for row in picked]
+
+    start = time.perf_counter()
+    exact = [nearest(tree, word, k) for word in words]
+    exact_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    approx = [nearest(tree, word, k, index=index, probes=probes) for word in words]
+    approx_time = time.perf_counter() - start
+
+    hits = 0
+    total = 0
+
+    for truth, guess in zip(exact, approx):
+        if truth is None:
+            continue
+
+        hits += len(set(w for w, _ in truth) & set(w for w, _ in guess))
+        total += len(truth)
+
+    report = {
+        'recall': hits / total if total else 0.0,
+        'exact_ms': 1000 * exact_time / max(len(words), 1),
+        'approx_ms': 1000 * approx_time / max(len(words), 1),
+    }
+
+    print('recall@%d: %.3f' % (k, report['recall']))
+    print('exact search: %.3f ms per query' % report['exact_ms'])
+    print('LSH search:   %.3f ms per query' % report['approx_ms'])
+
+    return report
+
+
+# Answers analogy questions (a, b, c), read as a - b + c: for each one returns
+# the k words closest by cosine similarity to unit(a) - unit(b) + unit(c),
+# best first, never counting a, b or c themselves. The words are resolved with
+# lookup_many and questions with a word that is not in the tree get None. Up
+# to batch offset vectors at a time are scored against the normalized matrix
+# block by block, one matrix product per block, keeping only the best k of
+# every block as nearest does.
+@timed('query')
+def analogy(tree, questions, k=1, block=65536, batch=1024):
+
+    questions = [tuple(question) for question in questions]
+    words = list(dict.fromkeys(word for question in questions for word in question))
+    rows = dict(zip(words, tree.lookup_many(words).tolist()))
+    found = [i for i, question in enumerate(questions) if all(rows[word] >= 0 for word in question)]
+    results = [None] * len(questions)
+    store = tree.store
+
+    for i in found:
+        results[i] = []
+
+    if k <= 0:
+        return results
+
+    for first in range(0, len(found), batch):
+        part = found[first:first + batch]
+        inputs = np.array([[rows[word] for word in questions[i]] for i in part], dtype=np.int64)
+
+        queries = store.unit_rows(inputs[:, 0]) - store.unit_rows(inputs[:, 1]) + store.unit_rows(inputs[:, 2])
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        queries = (queries / norms).astype(np.float32)
+
+        cand_rows = []
+        cand_scores = []
+
+        for start in range(0, len(store), block):
+            scores = store.block_scores(queries, start, start + block)
+
+            # Rule out the question's own words that fall in this block.
+            local = inputs - start
+            inside = (local >= 0) & (local < scores.shape[1])
+            scores[np.nonzero(inside)[0], local[inside]] = -np.inf
+
+            kb = min(k, scores.shape[1])
+            top = np.argpartition(-scores, kb - 1, axis=1)[:, :kb]
+
+            cand_rows.append(top + start)
+            cand_scores.append(np.take_along_axis(scores, top, axis=1))
+
+        cand_rows = np.hstack(cand_rows)
+        cand_scores = np.hstack(cand_scores)
+        order = np.argsort(-cand_scores, axis=1, kind='stable')[:, :k]
+
+        for j, i in enumerate(part):
+            results[i] = [(store.words[cand_rows[j, o]], float(cand_scores[j, o]))
+                          for o in order[j] if cand_scores[j, o] > -np.inf]
+
+    return results
+
+
+# Scores a file of analogy questions in the usual format: a line starting
+# with ':' begins a section, and every other line is 'a b c d', meaning a is
+# to b as c is to d. Each question is asked as b - a + c and counts as right
+# if d is the best answer. Words are lowercased to match the GloVe
+# vocabulary. Prints the accuracy of every section and overall, the share of
+# questions whose words are all in the tree, and questions per second.
+# Returns the numbers as a dict.
+def analogy_file(tree, filename, batch=1024):
+
+    questions = []
+    expected = []
+    sections = []
+    section = ''
+
+    with open(filename, encoding='utf-8') as f:
+
+        for line in f:
+            tempArray = line.split()
+
+            if not tempArray:
+                continue
+
+            if tempArray[0].startswith(':'):
+                section = ' '.join(tempArray)[1:].strip()
+
+            elif len(tempArray) >= 4:
+                a, b, c, d = (word.lower() for word in tempArray[:4])
+                questions.append((b, a, c))
+                expected.append(d)
+                sections.append(section)
+
+    start = time.perf_counter()
+    answers = analogy(tree, questions, 1, batch=batch)
+    elapsed = time.perf_counter() - start
+
+    counts = {}
+
+    for name, want, answer in zip(sections, expected, answers):
+        total, answered, correct = counts.get(name, (0, 0, 0))
+        counts[name] = (total + 1, answered + (answer is not None),
+                        correct + (bool(answer) and answer[0][0] == want))
+
+    report = {'questions': len(questions), 'seconds': elapsed,
+              'questions_per_s': len(questions) / elapsed if elapsed > 0 else None, 'sections': {}}
+
+    for name, (total, answered, correct) in counts.items():
+        report['sections'][name] = {'questions': total, 'answered': answered, 'correct': correct,
+                                    'accuracy': correct / answered if answered else None}
+        print('%-30s %5d/%5d answered  accuracy %s'
+              % (name, answered, total, '%.2f%%' % (100 * correct / answered) if answered else '-'))
+
+    answered = sum(entry[1] for entry in counts.values())
+    correct = sum(entry[2] for entry in counts.values())
+    report.update({'answered': answered, 'correct': correct,
+                   'accuracy': correct / answered if answered else None,
+                   'coverage': answered / len(questions) if questions else None})
+
+    print('Overall: %d/%d answered, accuracy %s, %.0f questions/sec'
+          % (answered, len(questions), '%.2f%%' % (100 * correct / answered) if answered else '-',
+             report['questions_per_s'] or 0))
+
+    return report
+
+
+# Cosine similarity of every pair of words in the list, computed in square
+# tiles straight from the store's unit rows. The tile side is chosen so that
+# the unit rows of the words plus the tiles in flight stay within max_bytes.
+# With output, the full float32 matrix is written to that .npy file through a
+# memory map, tile by tile; tiles below the diagonal are copied from the ones
+# above, since the matrix is symmetric. Otherwise only the top_k most similar
+# other words of each word are kept. Words not in the tree are reported and
+# left out. Returns the words kept and either the memory-mapped matrix or a
+# list of (word, similarity) lists, one per word.
+@timed('query')
+def similarity_matrix(tree, words, output=None, top_k=10, max_bytes=256 * 2**20):
+
+    words = list(dict.fromkeys(words))
+    rows = tree.lookup_many(words)
+
+    for word, row in zip(words, rows.tolist()):
+        if row < 0:
+            print(word+' is not in the tree')
+
+    words = [word for word, row in zip(words, rows.tolist()) if row >= 0]
+    unit = np.asarray(tree.store.unit_rows(rows[rows >= 0]), dtype=np.float32)
+    n = len(words)
+
+    # Writing the matrix holds one float32 tile at a time. Keeping the top k
+    # also holds a copy of the tile's scores and their int64 columns.
+    cell = 4 if output is not None else 16
+    tile = max(1, min(n, int(np.sqrt(max(max_bytes - unit.nbytes, 0) / cell))))
+
+    if output is not None:
+        matrix = np.lib.format.open_memmap(output, mode='w+', dtype=np.float32, shape=(n, n))
+
+        for i in range(0, n, tile):
+            for j in range(i, n, tile):
+                scores = unit[i:i + tile] @ unit[j:j + tile].T
+                matrix[i:i + tile, j:j + tile] = scores
+
+                if j != i:
+                    matrix[j:j + tile, i:i + tile] = scores.T
+
+        matrix.flush()
+
+        return words, matrix
+
+    if top_k <= 0:
+        return words, [[] for _ in words]
+
+    results = []
+
+    for i in range(0, n, tile):
+        cand_rows = np.empty((min(tile, n - i), 0), dtype=np.int64)
+        cand_scores = np.empty((min(tile, n - i), 0), dtype=np.float32)
+
+        for j in range(0, n, tile):
+            scores = unit[i:i + tile] @ unit[j:j + tile].T
+
+            # A word is not its own neighbour.
+            if i == j:
+                np.fill_diagonal(scores, -np.inf)
+
+            cand_rows = np.hstack([cand_rows, np.broadcast_to(np.arange(j, j + scores.shape[1]), scores.shape)])
+            cand_scores = np.hstack([cand_scores, scores])
+
+            if top_k < cand_scores.shape[1]:
+                top = np.argpartition(-cand_scores, top_k - 1, axis=1)[:, :top_k]
+                cand_rows = np.take_along_axis(cand_rows, top, axis=1)
+                cand_scores = np.take_along_axis(cand_scores, top, axis=1)
+
+        order = np.argsort(-cand_scores, axis=1, kind='stable')
+
+        for r in range(len(order)):
+            results.append([(words[cand_rows[r, o]], float(cand_scores[r, o]))
+                            for o in order[r] if cand_scores[r, o] > -np.inf])
+
+    return words, results
+
+
+# Returns the cosine similarity of each (word1, word2) pair, in order, and
+# for each pair the list of its words that are not in the tree. Pairs with a
+# missing word get None. Every distinct word is resolved once with
+# lookup_many; in batch mode all the similarities are then computed at once
+# with batch_similarity, otherwise one calculate_similarity call per pair.
+# With a LookupCache, pairs it already holds are answered from it.
+@timed('query')
+def score_pairs(tree, pairs, batch=True, cache=None):
+
+    if cache is not None:
+        return cached_scores(cache, pairs, lambda todo: score_pairs(tree, todo, batch))
+
+    words = list(dict.fromkeys(word for pair in pairs for word in pair))
+    rows = {}
+
+    for word, row in zip(words, tree.lookup_many(words).tolist()):
+        rows[word] = row if row >= 0 else None
+
+    found = [i for i, (word1, word2) in enumerate(pairs)
+             if rows[word1] is not None and rows[word2] is not None]
+    scores = [None] * len(pairs)
+
+    if batch and found:
+        rows1 = np.array([rows[pairs[i][0]] for i in found], dtype=np.intp)
+        rows2 = np.array([rows[pairs[i][1]] for i in found], dtype=np.intp)
+
+        for i, score in zip(found, batch_similarity(tree.store, rows1, rows2).tolist()):
+            scores[i] = score
+
+    elif found:
+        for i in found:
+            word1 = tree.store.get(rows[pairs[i][0]])
+            word2 = tree.store.get(rows[pairs[i][1]])
+            scores[i] = float(calculate_similarity(word1, word2)[0, 0])
+
+    missing = [[word for word in pair if rows[word] is None] for pair in pairs]
+
+    return scores, missing
+
+
+# Answers pairs from cache where it can and scores the distinct pairs it does
+# not hold with one call to score, which takes a list of pairs and returns
+# (scores, missing) like score_pairs. The new scores are added to the cache
+# under the same keys LookupCache.similarity uses.
+def cached_scores(cache, pairs, score):
+
+    scores = [None] * len(pairs)
+    todo = {}
+
+    for i, (word1, word2) in enumerate(pairs):
+        key = ('pair', word1, word2) if word1 <= word2 else ('pair', word2, word1)
+        hit, value = cache.get(key)
+
+        if hit:
+            scores[i] = value
+        else:
+            todo.setdefault(key, []).append(i)
+
+    if todo:
+        keys = list(todo)
+        found, _ = score([key[1:] for key in keys])
+
+        for key, value in zip(keys, found):
+            cache.put(key, value)
+
+            for i in todo[key]:
+                scores[i] = value
+
+    missing = [[] if value is not None else [word for word in pair if cache.lookup(word) is None]
+               for pair, value in zip(pairs, scores)]
+
+    return scores, missing
+
+
+# The SharedStore a pair-scoring worker process attached to when it started.
+WORKER_STORE = None
+
+
+# Runs once in each worker process of a SharedScorer, so every later shard
+# reuses the same attachment.
+def attach_worker(handle):
+
+    global WORKER_STORE
+    WORKER_STORE = SharedStore.attach(handle)
+
+
+# Scores one shard of pairs against the worker's SharedStore. Runs in a
+# worker process: the words are resolved with the shared vocabulary instead
+# of a tree, and only plain lists are sent back.
+def score_shard(pairs):
+
+    store = WORKER_STORE
+    words = list(dict.fromkeys(word for pair in pairs for word in pair))
+    rows = {}
+
+    for word, row in zip(words, store.lookup_many(words).tolist()):
+        rows[word] = row if row >= 0 else None
+
+    found = [i for i, (word1, word2) in enumerate(pairs)
+             if rows[word1] is not None and rows[word2] is not None]
+    scores = [None] * len(pairs)
+
+    if found:
+        rows1 = np.array([rows[pairs[i][0]] for i in found], dtype=np.intp)
+        rows2 = np.array([rows[pairs[i][1]] for i in found], dtype=np.intp)
+
+        for i, score in zip(found, store.pair_similarity(rows1, rows2).tolist()):
+            scores[i] = score
+
+    missing = [[word for word in pair if rows[word] is None] for pair in pairs]
+
+    return scores, missing
+
+
+class SharedScorer:
+    # A SharedStore copy of a store together with a pool of workers processes
+    # that attached to it when they started. Both are made once and reused
+    # by every score call, and close, also run at exit, shuts the pool down
+    # and frees the shared block. version is the version of the tree the
+    # store belongs to.
+    def __init__(self, store, workers, version=0):
+        self.store = store
+        self.workers = workers
+        self.version = version
+        self.shared = SharedStore.create(store)
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=attach_worker,
+                                        initargs=(self.shared.handle,))
+        atexit.register(self.close)
+
+    # Scores the pairs in contiguous shards, one per worker, and joins the
+    # results back in input order.
+    def score(self, pairs):
+
+        pairs = list(pairs)
+        size = max(1, -(-len(pairs) // self.workers))
+        shards = [pairs[i:i + size] for i in range(0, len(pairs), size)]
+        scores = []
+        missing = []
+
+        for part_scores, part_missing in self.pool.map(score_shard, shards):
+            scores.extend(part_scores)
+            missing.extend(part_missing)
+
+        return scores, missing
+
+    def close(self):
+
+        if self.shared is None:
+            return
+
+        self.pool.shutdown()
+        self.shared.close()
+        self.shared.unlink()
+        self.shared = None
+        atexit.unregister(self.close)
+
+
+# Returns the tree's SharedScorer with workers processes, creating it on
+# first use. It is made again only when the tree or its store has changed
+# since, or a different number of workers is asked for.
+def shared_scorer(tree, workers=None):
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    scorer = tree.scorer
+
+    if (scorer is not None and scorer.shared is not None and scorer.store is tree.store and
+            scorer.workers == workers and scorer.version == tree.version):
+        return scorer
+
+    if scorer is not None:
+        scorer.close()
+
+    tree.scorer = SharedScorer(tree.store, workers, tree.version)
+
+    return tree.scorer
+
+
+# Same result as score_pairs, computed by workers processes. The vectors and
+# vocabulary sit in shared memory once, in the tree's SharedScorer, and every
+# worker scores one contiguous shard of the pairs against them. Each worker
+# only holds its shard, not a tree or a matrix. With a LookupCache, pairs it
+# already holds are answered from it.
+@timed('query')
+def score_pairs_shared(tree, pairs, workers=None, cache=None):
+
+    if cache is not None:
+        return cached_scores(cache, pairs, lambda todo: shared_scorer(tree, workers).score(todo))
+
+    return shared_scorer(tree, workers).score(pairs)
+
+
+# Swaps the tree's float32 store for a float16 or int8 QuantizedStore. The
+# rows stay the same, so the tree itself is untouched, but it is marked as
+# changed so caches of float32 scores are dropped. The tree's LSHIndex, if
+# it has one, is moved onto the new store.
+def quantize_tree(tree, mode='int8'):
+
+    tree.store = QuantizedStore(tree.store, mode)
+    tree.changed()
+
+    if tree.index is not None:
+        tree.index.store = tree.store
+
+    return tree
+
+
+# Compares cosine similarities computed from a float16 or int8 copy of the
+# tree's vectors against the float32 ones, on the pairs in filename and on
+# samples random pairs of rows. Prints the mean and largest absolute error
+# and the memory of both forms, and returns the numbers as a dict.
+def quantization_report(tree, mode='int8', filename='match_words.txt', samples=10000, seed=0):
+
+    quantized = QuantizedStore(tree.store, mode)
+    report = {'mode': mode, 'float32_bytes': int(tree.store.matrix[:tree.store.count].nbytes),
+              'quantized_bytes': int(quantized.nbytes())}
+
+    rows1 = []
+    rows2 = []
+
+    if os.path.exists(filename):
+        with open(filename) as f:
+            pairs = [line.split()[:2] for line in f if len(line.split()) >= 2]
+
+        words = [word for pair in pairs for word in pair]
+        rows = tree.lookup_many(words)
+
+        for i in range(0, len(rows), 2):
+            if rows[i] >= 0 and rows[i + 1] >= 0:
+                rows1.append(rows[i])
+                rows2.append(rows[i + 1])
+
+    rng = np.random.default_rng(seed)
+    checks = [('pairs file', np.array(rows1, dtype=np.int64), np.array(rows2, dtype=np.int64)),
+              ('random', rng.integers(0, len(tree.store), samples), rng.integers(0, len(tree.store), samples))]
+
+    print('%s storage: %d bytes instead of %d' % (mode, report['quantized_bytes'], report['float32_bytes']))
+
+    for label, a, b in checks:
+        if len(a) == 0:
+            continue
+
+        error = np.abs(quantized.pair_similarity(a, b) - tree.store.pair_similarity(a, b))
+        report[label] = {'pairs': int(len(a)), 'mean_error': float(error.mean()), 'max_error': float(error.max())}
+
+        print('%-10s %6d pairs  mean error %.2e  max error %.2e'
+              % (label, len(a), error.mean(), error.max()))
+
+    return report
+
+
+# Reads the pairs file and prints the similarity of each pair, in the same
+# order as the file. Pairs with a word that is not in the tree are reported
+# as missing. Returns a list of (word1, word2, similarity) with None for the
+# missing pairs. With more than one worker the pairs are scored by
+# score_pairs_shared. A LookupCache given as cache answers the pairs it
+# already holds.
+def read_and_match(tree, filename='match_words.txt', batch=True, workers=1, cache=None):
+
+    with open(filename) as f:
+
+        lines = f.read().splitlines()
+
+    pairs = []
+
+    for line in lines:
+        tempArray = line.split()
+
+        if len(tempArray) >= 2:
+            pairs.append((tempArray[0], tempArray[1]))
+
+    if workers > 1:
+        scores, missing = score_pairs_shared(tree, pairs, workers, cache)
+    else:
+        scores, missing = score_pairs(tree, pairs, batch, cache)
+
+    results = []
+
+    for (word1, word2), score, absent in zip(pairs, scores, missing):
+
+        if score is None:
+            print(word1+' '+word2+' missing: '+' '.join(absent))
+
+        else:
+            print(word1+' '+word2+' '+str(score))
+
+        results.append((word1, word2, score))
+
+    return results
+
+
+# Builds an AVL tree from (word, vector) pairs, either one insertion at a time
+# or with a single sorted bulk load.
+@timed('build')
+def buildAVL(pairs, bulk=False):
+
+    avl = AVLTree()
+    pairs = ((word, vector) for word, vector in pairs if word[0].isalpha())
+
+    if bulk:
+        avl.bulk_load(pairs)
+
+    else:
+        for testWord, vector in pairs:
+            row = avl.store.add(testWord, vector)
+            node = Node(testWord, row)
+            avl.insert(node)
+
+    avl.store.trim()
+
+    return avl
+
+
+# Builds a red-black tree from (word, vector) pairs, either one insertion at a
+# time or with a single sorted bulk load.
+@timed('build')
+def buildRedBlack(pairs, bulk=False):
+
+    node = RedBlackTree()
+    pairs = ((word, vector) for word, vector in pairs if word[0].isalpha())
+
+    if bulk:
+        node.bulk_load(pairs)
+
+    else:
+        for testWord, vector in pairs:
+            row = node.store.add(testWord, vector)
+            node.insert(testWord, row)
+
+    node.store.trim()
+
+    return node
+
+
+# Builds a tree of kind from a vocabulary and the float32 matrix holding its
+# vectors, as returned by readFileParallel. The matrix becomes the store's
+# matrix as it is: the rows of skipped words are compacted out in place, a
+# block at a time, and the spare rows are then dropped by trim, so the
+# vectors are never copied into a second buffer.
+@timed('build')
+def buildFromMatrix(words, matrix, kind, bulk=False, block=65536):
+
+    keep = [i for i, word in enumerate(words) if word[0].isalpha()]
+
+    if len(keep) < len(words):
+
+        # keep is ascending, so every row a block reads is at or after the
+        # rows it writes, and no row is overwritten before it is moved.
+        for start in range(0, len(keep), block):
+            rows = keep[start:start + block]
+            matrix[start:start + len(rows)] = matrix[rows]
+
+        words = [words[i] for i in keep]
+
+    store = EmbeddingStore()
+    store.matrix = matrix
+    store.words = words
+    store.count = len(words)
+    store.trim()
+
+    items = list(zip(words, range(len(words))))
+
+    if kind == 'avl':
+        tree = AVLTree(store)
+    else:
+        tree = RedBlackTree(store)
+
+    if bulk:
+        tree.bulk_load_rows(items)
+
+    elif kind == 'avl':
+        for word, row in items:
+            tree.insert(Node(word, row))
+
+    else:
+        for word, row in items:
+            tree.insert(word, row)
+
+    return tree
+
+
+# Builds a tree over a LazyStore of source: only the words and line offsets
+# are read up front, and vectors are parsed when they are first used.
+@timed('build')
+def buildLazy(source, kind, bulk=False, cache_size=100000):
+
+    store = LazyStore(source, cache_size).scan(lambda word: word[0].isalpha())
+
+    if kind == 'avl':
+        tree = AVLTree(store)
+    else:
+        tree = RedBlackTree(store)
+
+    items = zip(store.words, range(len(store)))
+
+    if bulk:
+        tree.bulk_load_rows(items)
+
+    elif kind == 'avl':
+        for word, row in items:
+            tree.insert(Node(word, row))
+
+    else:
+        for word, row in items:
+            tree.insert(word, row)
+
+    return tree
+
+
+# A snapshot is a directory next to the embedding file holding everything
+# needed to bring a built tree back without parsing the text again:
+#   vectors.npy  the embedding matrix, memory-mapped on load
+#   words.txt    the word stored at each matrix row
+#   tree.npz     the tree shape as preorder arrays of rows, child positions
+#                and colors
+#   meta.json    the size and modification time of the source file, written
+#                last so a half-written snapshot is never treated as valid
+#   index.npz    the LSHIndex over the vectors, added by openIndex the first
+#                time an index is asked for
+SNAPSHOT_VERSION = 1
+INDEX_FILE = 'index.npz'
+
+
+def snapshot_path(source, kind):
+
+    return source + '.' + kind + '.snapshot'
+
+
+def source_stamp(source):
+
+    stat = os.stat(source)
+
+    return {'version': SNAPSHOT_VERSION, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+# Saves tree as a snapshot of source. kind is 'avl' or 'rb'.
+def save_snapshot(tree, source, kind):
+
+    path = snapshot_path(source, kind)
+    os.makedirs(path, exist_ok=True)
+
+    # The index of an earlier snapshot was hashed from its vectors, so it
+    # goes along with the old metadata.
+    for name in ('meta.json', INDEX_FILE):
+        if os.path.exists(os.path.join(path, name)):
+            os.remove(os.path.join(path, name))
+
+    meta = os.path.join(path, 'meta.json')
+    store = tree.store
+    np.save(os.path.join(path, 'vectors.npy'), store.matrix[:store.count])
+
+    with open(os.path.join(path, 'words.txt'), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(store.words))
+
+    # Number the nodes in preorder, so every child comes after its parent.
+    order = []
+    stack = [tree.root] if tree.root is not None else []
+
+    while stack:
+        node = stack.pop()
+        order.append(node)
+
+        if node.right is not None:
+            stack.append(node.right)
+        if node.left is not None:
+            stack.append(node.left)
+
+    position = {id(node): i for i, node in enumerate(order)}
+    rows = np.array([node.code for node in order], dtype=np.int64)
+    left = np.array([position[id(node.left)] if node.left is not None else -1 for node in order], dtype=np.int64)
+    right = np.array([position[id(node.right)] if node.right is not None else -1 for node in order], dtype=np.int64)
+    red = np.array([kind == 'rb' and node.red for node in order], dtype=bool)
+
+    np.savez(os.path.join(path, 'tree.npz'), rows=rows, left=left, right=right, red=red)
+
+    with open(meta, 'w') as f:
+        json.dump(source_stamp(source), f)
+
+
+# Returns True if there is a complete snapshot of source for kind and it was
+# made from the current version of the source file.
+def snapshot_is_valid(source, kind):
+
+    try:
+        with open(os.path.join(snapshot_path(source, kind), 'meta.json')) as f:
+            return json.load(f) == source_stamp(source)
+
+    except (OSError, ValueError):
+        return False
+
 
-        # Parent needed for rebalancing.
-        parent = node.parent
+# Returns the tree saved in the snapshot of source, or None if there is no
+# valid snapshot. The matrix is memory-mapped, so its pages are only read as
+# they are used.
+@timed('load')
+def load_snapshot(source, kind):
 
-        # Case 1: Internal node with 2 children
-        if node.left is not None and node.right is not None:
-            # Find successor
+    path = snapshot_path(source, kind)
 
-            successor_node = node.right
+    if not snapshot_is_valid(source, kind):
+        return None
 
-            while successor_node.left != None:
-                successor_node = successor_node.left
+    try:
+        matrix = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
 
-            # Copy the value from the node
-            node.key = successor_node.key
+        with open(os.path.join(path, 'words.txt'), encoding='utf-8') as f:
+            words = f.read().split('\n') if matrix.shape[0] else []
 
-            # Recursively remove successor
-            self.remove_node(successor_node)
+        with np.load(os.path.join(path, 'tree.npz')) as data:
+            rows = data['rows'].tolist()
+            left = data['left'].tolist()
+            right = data['right'].tolist()
+            red = data['red'].tolist()
 
-            # Nothing left to do since the recursive call will have rebalanced
-            return True
+    except (OSError, ValueError, KeyError):
+        return None
 
-        # Case 2: Root node (with 1 or 0 children)
-        elif node is self.root:
+    store = EmbeddingStore()
+    store.matrix = matrix
+    store.words = words
+    store.count = len(words)
 
-            if node.left is not None:
-                self.root = node.left
+    if kind == 'avl':
+        tree = AVLTree(store)
+        nodes = [Node(words[row], row) for row in rows]
+    else:
+        tree = RedBlackTree(store)
+        nodes = [RBTNode(words[row], row, None, red[i]) for i, row in enumerate(rows)]
 
-            else:
-                self.root = node.right
+    # Children come after their parent in preorder, so linking from the end
+    # finishes every subtree before its root's height is computed.
+    for i in range(len(nodes) - 1, -1, -1):
+        if left[i] >= 0:
+            nodes[i].set_child('left', nodes[left[i]])
+        if right[i] >= 0:
+            nodes[i].set_child('right', nodes[right[i]])
 
-            if self.root is not None:
-                self.root.parent = None
+    if nodes:
+        tree.root = nodes[0]
 
-            return True
+    return tree
 
-        # Case 3: Internal with left child only
-        elif node.left is not None:
-            parent.replace_child(node, node.left)
 
-        # Case 4: Internal with right child only OR leaf
-        else:
-            parent.replace_child(node, node.right)
+# Returns the tree for source, preferring a valid snapshot and otherwise
+# parsing the file, building the tree and saving a fresh snapshot of it. With
+# more than one worker the file is parsed by readFileParallel and the tree
+# is built over the parsed matrix by buildFromMatrix. With lazy the tree is
+# built by buildLazy instead.
+def openTree(source, kind, bulk=False, workers=1, snapshot=True, lazy=False, cache_size=100000):
 
-        # node is gone. Anything that was below node that has persisted is already correctly
-        # balanced, but ancestors of node may need rebalancing.
-        node = parent
+    # Lazy trees read their vectors from the source file itself, so they are
+    # never snapshotted.
+    if lazy:
+        return buildLazy(source, kind, bulk, cache_size)
 
-        while node is not None:
-            self.rebalance(node)
-            node = node.parent
+    tree = load_snapshot(source, kind) if snapshot else None
 
-        return True
+    if tree is not None:
+        print('Loaded snapshot '+snapshot_path(source, kind))
+        return tree
 
+    if workers > 1:
+        words, matrix = readFileParallel(source, workers)
+        tree = buildFromMatrix(words, matrix, kind, bulk)
 
-class RBTNode:
-    def __init__(self, key, cd, parent, is_red=False, left=None, right=None):
-        self.key = key
-        self.code = cd
-        self.left = left
-        self.right = right
-        self.parent = parent
-        self.height = 0
+    elif kind == 'avl':
+        tree = buildAVL(readFile(source), bulk)
+    else:
+        tree = buildRedBlack(readFile(source), bulk)
 
-        if is_red:
-            self.color = "red"
+    if snapshot:
+        save_snapshot(tree, source, kind)
 
-        else:
-            self.color = "black"
+    return tree
 
-    # Returns true if both child nodes are black. A child set to None is considered
-    # to be black.
-    def are_both_children_black(self):
 
-        if self.left != None and self.left.is_red():
-            return False
+# Returns an LSHIndex over tree's store. When tree came from a valid snapshot
+# of source, the index saved in it is loaded if it fits the store; otherwise
+# the index is built and, with a snapshot, saved there for the next start.
+def openIndex(tree, source, kind, snapshot=True):
 
-        if self.right != None and self.right.is_red():
-            return False
-        return True
+    saved = snapshot and snapshot_is_valid(source, kind)
+    path = os.path.join(snapshot_path(source, kind), INDEX_FILE)
 
-    def count(self):
-        count = 1
+    if saved and os.path.exists(path):
+        try:
+            index = LSHIndex.load(path, tree.store)
 
-        if self.left != None:
-            count = count + self.left.count()
+            if index.order.shape[1] == len(tree.store) and index.planes.shape[2] == tree.store.dim():
+                print('Loaded index '+path)
+                return index
 
-        if self.right != None:
-            count = count + self.right.count()
+        except (OSError, ValueError, KeyError):
+            pass
 
-        return count
-    def update_height(self):
+    index = LSHIndex(tree.store).build()
 
-        # Get current height of left subtree, or -1 if None
-        left_height = -1
+    # Written under another name first, so a half-written index is never
+    # loaded.
+    if saved:
+        with open(path + '.tmp', 'wb') as f:
+            index.save(f)
 
-        if self.left is not None:
-            left_height = self.left.height
+        os.replace(path + '.tmp', path)
 
-        # Get current height of right subtree, or -1 if None
-        right_height = -1
+    return index
 
-        if self.right is not None:
-            right_height = self.right.height
 
-        # Assign self.height with calculated node height.
-        self.height = max(left_height, right_height) + 1
+def nextStep(node):#next step serves as a menu to continue after the Binary Search Tree is Created
 
-    # Returns the grandparent of this node
-    def get_grandparent(self):
+    # The menu runs in a loop rather than calling itself after every
+    # command, so long sessions do not grow the stack.
+    while True:
+        print('What would you like to do? (Enter Number)')
+        print('1. Count the number of Nodes in BST ')
+        print('2. Get the height of BST')
+        print('3. Print BST to a file in ascending order')
+        print('4. Print BST at certain Depth into file')
+        print('5. Read Pair File and find similarity')
+        print('6. Find the closest words to a word')
+        print('7. Exit')
 
-        if self.parent is None:
-            return None
+        answer = ''
+        answer = input(str('Enter Number: '))
 
-        return self.parent.parent
+        if answer == '1':
+            number = len(node)
+            print('Number of nodes in BST is: '+str(number))
 
-    # Gets this node's predecessor from the left child subtree
-    # Precondition: This node's left child is not None
-    def get_predecessor(self):
+        elif answer == '2':
+            print(node.root.height)
 
-        node = self.left
+        elif answer == '3':
+            vectors = input(str('To include the vectors type y: ')) == 'y'
 
-        while node.right is not None:
-            node = node.right
+            with open("writeFile.txt", "w", encoding='utf-8') as f:
+                pBST(node.root, f, node.store if vectors else None)
 
-        return node
+        elif answer == '4':
+            num = int(input(str('Enter Depth of tree you want to print: ')))
 
-    # Returns this node's sibling, or None if this node does not have a sibling
-    def get_sibling(self):
+            with open("writeFile.txt", "w", encoding='utf-8') as f:
+                patdepth(node.root, f, num)
 
-        if self.parent is not None:
+        elif answer == '5':
+            read_and_match(node)
 
-            if self is self.parent.left:
-                return self.parent.right
+        elif answer == '6':
+            word = input(str('Enter word: '))
+            k = int(input(str('Enter how many words to find: ')))
+            closest = nearest(node, word, k, index=node.index)
 
-            return self.parent.left
+            if closest is not None:
+                for other, score in closest:
+                    print(other+' '+str(score))
 
-        return None
+        elif answer == '7':
+            if STATS is not None:
+                print(STATS.report())
+            print('goodbye')
+            return
 
-    # Returns the uncle of this node
-    def get_uncle(self):
+        else:
+            print('Invalid Input')
 
-        grandparent = self.get_grandparent()
 
-        if grandparent is None:
-            return None
+def main(filename):#main caller to initiate if the Tree will be created as a AVL or Red Black Tree
+    answer = input(str('To use an AVL tree type 1 to use a Red Black Tree type 2: '))
+    i = 0
+    while i != 3:
+        if answer == '1' or answer == '2':
+            kind = 'avl' if answer == '1' else 'rb'
+            bulk = False
+            workers = 1
 
-        if grandparent.left is self.parent:
-            return grandparent.right
+            if not snapshot_is_valid(filename, kind):
+                build = input(str('To insert words one at a time type 1 to bulk load them type 2: '))
+                bulk = build == '2'
+                processes = input(str('Processes to parse the file with (press enter for 1): '))
+                workers = int(processes) if processes.isdigit() and int(processes) > 0 else 1
 
-        return grandparent.left
+            index = input(str('To also build an approximate nearest-word index type y: ')) == 'y'
 
-    # Returns True if this node is black, False otherwise
-    def is_black(self):
+            tree = openTree(filename, kind, bulk, workers)
 
-        return self.color == "black"
+            if index:
+                tree.index = openIndex(tree, filename, kind)
 
-    # Returns True if this node is red, False otherwise
-    def is_red(self):
+            nextStep(tree)
+            break
+        else:
+            print('Invalid Answer')
+            answer = input(str('To use an AVL tree type 1 to use a Red Black Tree type 2: '))
+            i += 1
 
-        return self.color == "red"
 
-    # Replaces one of this node's children with a new child
-    def replace_child(self, current_child, new_child):
+# The smallest and largest number of arguments each query script command
+# takes, not counting the command itself.
+COMMAND_ARGUMENTS = {
+    'count': (0, 0), 'height': (0, 0), 'depth': (1, 1), 'dump': (1, 2),
+    'similarity': (2, 2), 'nearest': (1, 2), 'analogy': (3, 4),
+    'analogies': (1, 1), 'matrix': (2, 3), 'topk': (2, 3), 'recall': (0, 3),
+    'quantization': (1, 2),
+}
 
-        if self.left is current_child:
-            return self.set_child("left", new_child)
 
-        elif self.right is current_child:
-            return self.set_child("right", new_child)
+# Whether token is a positive number, as the megabyte budget of matrix and
+# topk must be.
+def is_megabytes(token):
 
+    try:
+        return float(token) > 0
+    except ValueError:
         return False
 
-    # Sets either the left or right child of this node
-    def set_child(self, which_child, child):
 
-        if which_child != "left" and which_child != "right":
-            return False
+# Returns why command is malformed, or None when it can be run: an unknown
+# command, the wrong number of arguments, or an argument that should be a
+# number and is not.
+def command_error(command):
 
-        if which_child == "left":
-            self.left = child
-        else:
-            self.right = child
+    op = command[0]
 
-        if child != None:
-            child.parent = self
+    if op not in COMMAND_ARGUMENTS:
+        return 'unknown command'
 
-        self.update_height()
-        return True
+    low, high = COMMAND_ARGUMENTS[op]
 
+    if not low <= len(command) - 1 <= high:
+        if low == high:
+            return '%s takes %d argument%s, got %d' % (op, low, '' if low == 1 else 's', len(command) - 1)
 
-class RedBlackTree:
-    def __init__(self):
-        self.root = None
+        return '%s takes %d to %d arguments, got %d' % (op, low, high, len(command) - 1)
 
-    def __len__(self):
-        if self.root is None:
-            return 0
-        return self.root.count()
+    if op == 'depth' and not command[1].lstrip('-').isdigit():
+        return 'depth must be an integer'
 
-    def insert(self, key, cd):
+    if op == 'dump' and len(command) > 2 and command[2] != 'vectors':
+        return "dump's second argument can only be 'vectors'"
 
-        new_node = RBTNode(key, cd, None, True, None, None)
+    if (op == 'nearest' and len(command) > 2 and not command[2].isdigit() or
+            op == 'analogy' and len(command) > 4 and not command[4].isdigit() or
+            op == 'topk' and not command[2].isdigit()):
+        return 'K must be a non-negative integer'
 
-        self.insert_node(new_node)
+    if op == 'quantization' and command[1] not in ('float16', 'int8'):
+        return "quantization mode must be 'float16' or 'int8'"
 
+    if op == 'recall' and not all(token.isdigit() for token in command[1:]):
+        return 'recall takes non-negative integers K, SAMPLES and PROBES'
 
-    def insert_node(self, node):
-        # Begin with normal BST insertion
-        if self.root is None:
-            # Special case for root
-            self.root = node
+    if op in ('matrix', 'topk') and len(command) > 3 and not is_megabytes(command[3]):
+        return 'the memory budget must be a positive number of megabytes'
 
-        else:
+    return None
 
-            current_node = self.root
 
-            while current_node is not None:
-                ascii1 = 1
-                ascii2 = 1
+# The K of a batched query command: nearest defaults to 10 and analogy to 1.
+# Similarity commands have none.
+def command_k(command):
 
-                for i in range(len(node.key)):
-                    ascii1 = ascii1 * ord(node.key[i])
+    if command[0] == 'nearest':
+        return int(command[2]) if len(command) > 2 else 10
 
-                for i in range(len(current_node.key)):
-                    ascii2 = ascii2 * ord(current_node.key[i])
+    if command[0] == 'analogy':
+        return int(command[4]) if len(command) > 4 else 1
 
-                ascii1 = ascii1 / len(node.key)
-                ascii2 = ascii2 / len(current_node.key)
+    return None
 
-                if ascii1 < ascii2:
 
-                    if current_node.left is None:
-                        current_node.set_child("left", node)
-                        break
+# Runs query script commands against tree and yields one result dict per
+# command, in order. A command is a list of tokens:
+#   count | height | depth N | dump FILE [vectors]
+#   similarity WORD1 WORD2 | nearest WORD [K] | analogy A B C [K]
+#   analogies FILE | matrix WORDS OUTPUT.npy [MB] | topk WORDS K [MB]
+#   recall [K] [SAMPLES] [PROBES] | quantization MODE [PAIRS]
+# Runs of similarity commands, and of nearest or analogy commands with the
+# same K, are answered together in one vectorized batch. Similarity batches
+# are split over processes workers with score_pairs_shared when processes is
+# more than one, and go through cache when a LookupCache is given. A
+# malformed command yields an object with an 'error' and the commands after
+# it still run.
+def execute_queries(tree, commands, index=None, processes=1, cache=None):
 
-                    else:
-                        current_node = current_node.left
+    i = 0
 
-                else:
+    while i < len(commands):
+        command = commands[i]
+        op = command[0]
+        error = command_error(command)
 
-                    if current_node.right is None:
-                        current_node.set_child("right", node)
-                        break
+        if error is not None:
+            yield {'op': op, 'error': error}
+            i += 1
+            continue
 
-                    else:
-                        current_node = current_node.right
+        if op in ('similarity', 'nearest', 'analogy'):
+            k = command_k(command)
+            j = i
 
-        # Color the node red
-        node.color = "red"
+            while (j < len(commands) and commands[j][0] == op and command_error(commands[j]) is None and
+                   command_k(commands[j]) == k):
+                j += 1
 
-        # Balance
-        self.insertion_balance(node)
+            batch = commands[i:j]
 
-    def insertion_balance(self, node):
+            if op == 'similarity':
+                pairs = [(c[1], c[2]) for c in batch]
 
-        node.update_height()
-        # If node is the tree's root, then color node black and return
+                if processes > 1:
+                    scores, missing = score_pairs_shared(tree, pairs, processes, cache)
+                else:
+                    scores, missing = score_pairs(tree, pairs, cache=cache)
 
-        if node.parent is None:
-            node.color = "black"
-            return
+                for (word1, word2), score, absent in zip(pairs, scores, missing):
+                    yield {'op': op, 'word1': word1, 'word2': word2,
+                           'similarity': score, 'missing': absent}
 
-        # If parent is black, then return without any alterations
-        if node.parent.is_black():
-            return
+            elif op == 'nearest':
+                words = [c[1] for c in batch]
 
-        # References to parent, grandparent, and uncle are needed for remaining operations
-        parent = node.parent
+                with redirect_stdout(sys.stderr):
+                    found = nearest(tree, words, k, index=index)
 
-        grandparent = node.get_grandparent()
+                for word, best in zip(words, found):
+                    yield {'op': op, 'word': word, 'k': k, 'missing': best is None,
+                           'neighbours': best or []}
 
-        uncle = node.get_uncle()
+            else:
+                questions = [tuple(c[1:4]) for c in batch]
 
-        # If parent and uncle are both red, then color parent and uncle black, color grandparent
-        # red, recursively balance  grandparent, then return
-        if uncle is not None and uncle.is_red():
-            parent.color = uncle.color = "black"
-            grandparent.color = "red"
-            self.insertion_balance(grandparent)
-            return
+                for question, best in zip(questions, analogy(tree, questions, k)):
+                    yield {'op': op, 'words': list(question), 'k': k, 'missing': best is None,
+                           'answers': best or []}
 
-        # If node is parent's right child and parent is grandparent's left child, then rotate left
-        # at parent, update node and parent to point to parent and grandparent, respectively
-        if node is parent.right and parent is grandparent.left:
-            self.rotate_left(parent)
-            node = parent
-            parent = node.parent
-        # Else if node is parent's left child and parent is grandparent's right child, then rotate
-        # right at parent, update node and parent to point to parent and grandparent, respectively
-        elif node is parent.left and parent is grandparent.right:
-            self.rotate_right(parent)
-            node = parent
-            parent = node.parent
+            i = j
+            continue
 
-        # Color parent black and grandparent red
-        parent.color = "black"
-        grandparent.color = "red"
+        if op == 'count':
+            yield {'op': op, 'count': len(tree)}
 
-        # If node is parent's left child, then rotate right at grandparent, otherwise rotate left
-        # at grandparent
-        if node is parent.left:
-            self.rotate_right(grandparent)
-        else:
-            self.rotate_left(grandparent)
+        elif op == 'height':
+            yield {'op': op, 'height': tree.root.height if tree.root is not None else -1}
 
-    def rotate_left(self, node):
+        elif op == 'recall':
+            k, samples, probes = [int(token) for token in command[1:]] + [10, 100, 2][len(command) - 1:]
 
-        right_left_child = node.right.left
+            if index is None:
+                yield {'op': op, 'error': 'recall needs an LSH index'}
 
-        if node.parent != None:
-            node.parent.replace_child(node, node.right)
+            else:
+                with redirect_stdout(sys.stderr):
+                    report = lsh_recall(tree, index, k=k, samples=samples, probes=probes)
 
-        else:  # node is root
-            self.root = node.right
-            self.root.parent = None
+                yield {'op': op, 'k': k, 'samples': samples, 'probes': probes, **report}
 
-        node.right.set_child("left", node)
-        node.set_child("right", right_left_child)
+        elif op == 'quantization':
+            if not isinstance(tree.store, EmbeddingStore):
+                yield {'op': op, 'error': 'quantization compares against the float32 vectors'}
 
-    def rotate_right(self, node):
+            else:
+                with redirect_stdout(sys.stderr):
+                    report = quantization_report(tree, command[1], *command[2:])
 
-        left_right_child = node.left.right
+                yield {'op': op, **report}
 
-        if node.parent != None:
-            node.parent.replace_child(node, node.left)
+        elif op == 'analogies':
+            with redirect_stdout(sys.stderr):
+                report = analogy_file(tree, command[1])
 
-        else:  # node is root
-            self.root = node.left
-            self.root.parent = None
+            yield {'op': op, 'file': command[1], **report}
 
-        node.left.set_child("right", node)
-        node.set_child("left", left_right_child)
+        elif op == 'matrix' or op == 'topk':
+            words = list(dict.fromkeys(c[0] for c in read_commands(command[1])))
+            max_bytes = int(float(command[3]) * 2**20) if len(command) > 3 else 256 * 2**20
 
+            with redirect_stdout(sys.stderr):
+                if op == 'matrix':
+                    kept, found = similarity_matrix(tree, words, command[2], max_bytes=max_bytes)
+                else:
+                    kept, found = similarity_matrix(tree, words, top_k=int(command[2]), max_bytes=max_bytes)
 
-def pBST(node, f):
+            if op == 'matrix':
+                present = set(kept)
+                yield {'op': op, 'file': command[2], 'words': kept,
+                       'missing': [word for word in words if word not in present]}
 
-    if node:
-        pBST(node.left, f)
-        f.write(node.key + '\n')
-        pBST(node.right, f)
+            else:
+                for word, best in zip(kept, found):
+                    yield {'op': op, 'word': word, 'k': int(command[2]), 'neighbours': best}
 
+        elif op == 'depth':
+            num = int(command[1])
+            yield {'op': op, 'depth': num, 'words': words_at_depth(tree.root, num)}
 
-def numNodes(node):
+        elif op == 'dump':
+            vectors = len(command) > 2
 
-    if node is None:
-        return 0
-    return 1 + numNodes(node.left) + numNodes(node.right)
+            with open(command[1], 'w', encoding='utf-8') as f:
+                pBST(tree.root, f, tree.store if vectors else None)
 
+            yield {'op': op, 'file': command[1], 'words': len(tree), 'vectors': vectors}
 
-def patdepth(node, f, num):
+        i += 1
 
-    if node is None:
-        return
 
-    if num > node.height:
-        print('BST does not have that depth')
-        return
+# Reads query commands from a file, or stdin for '-', skipping blank lines
+# and '#' comments.
+def read_commands(filename):
 
-    if num == 0:
-        f.write(node.key + '\n')
-        return
+    if filename == '-':
+        lines = sys.stdin.read().splitlines()
 
     else:
-        patdepth(node.left, f, num - 1)
-        patdepth(node.right, f, num - 1)
+        with open(filename, encoding='utf-8') as f:
+            lines = f.read().splitlines()
 
+    return [line.split() for line in lines if line.strip() and not line.lstrip().startswith('#')]
 
-def calculate_similarity(vector1, vector2):
 
-    if vector1 is None or vector2 is None:
-        print('Cannot proceed with an empty set.')
-        return None
+# Non-interactive entry point. Loads or builds the tree once, runs the
+# subcommand's queries against it and writes one JSON object per result to
+# stdout, followed by the per-phase timings. Progress messages go to stderr.
+def cli(argv):
 
-    array1 = np.array(vector1, dtype=float)
-    array2 = np.array(vector2, dtype=float)
+    parser = argparse.ArgumentParser(description='Word embedding lookups over an AVL or red-black tree.')
+    parser.add_argument('--embeddings', default='glove.6B.50d.txt', help='GloVe-format embedding file')
+    parser.add_argument('--tree', choices=('avl', 'rb'), default='avl')
+    parser.add_argument('--bulk', action='store_true', help='bulk load instead of inserting one word at a time')
+    parser.add_argument('--workers', type=int, default=1, help='processes used to parse the embedding file')
+    parser.add_argument('--no-snapshot', action='store_true', help='neither load nor save a snapshot')
+    parser.add_argument('--index', action='store_true', help='answer nearest queries with an LSH index')
+    parser.add_argument('--lazy', action='store_true', help='parse vectors only when they are first used')
+    parser.add_argument('--quantize', choices=('float16', 'int8'), help='keep the vectors in a smaller form')
+    parser.add_argument('--cache-size', type=int, default=100000, help='vectors kept parsed in lazy mode')
+    parser.add_argument('--cache-entries', type=int, default=0,
+                        help='keep this many recent similarity results in an LRU cache')
+    parser.add_argument('--instrument', action='store_true', help='also output instrumentation counters')
+    commands = parser.add_subparsers(dest='command', required=True)
 
-    array1 = array1.reshape(1,-1)
-    array2 = array2.reshape(1,-1)
+    commands.add_parser('build', help='build the tree and save its snapshot')
+    commands.add_parser('count', help='number of words in the tree')
+    commands.add_parser('height', help='height of the tree')
 
-    return cosine_similarity(array1,array2)
+    dump = commands.add_parser('dump', help='write the words in ascending order to a file')
+    dump.add_argument('--output', default='writeFile.txt')
+    dump.add_argument('--vectors', action='store_true')
 
+    depth = commands.add_parser('depth', help='words at a given depth')
+    depth.add_argument('depth', type=int)
 
+    similarity = commands.add_parser('similarity', help='cosine similarity of word pairs')
+    similarity.add_argument('words', nargs='*', help='WORD1 WORD2 [WORD1 WORD2 ...]')
+    similarity.add_argument('--input', help="file of 'word1 word2' lines, or - for stdin")
+    similarity.add_argument('--processes', type=int, default=1,
+                            help='score the pairs in this many processes over shared memory')
 
-def readFile(a):
+    closest = commands.add_parser('nearest', help='closest words to each query word')
+    closest.add_argument('words', nargs='*')
+    closest.add_argument('-k', type=int, default=10)
+    closest.add_argument('--input', help='file of query words, one per line, or - for stdin')
 
-    with open(a) as f:
-        list = f.read().splitlines()
+    analogies = commands.add_parser('analogy', help='words closest to A - B + C')
+    analogies.add_argument('words', nargs='*', help='A B C [A B C ...]')
+    analogies.add_argument('-k', type=int, default=1)
+    analogies.add_argument('--questions', help="score a file of 'a b c d' analogy questions")
 
-    return list
+    matrix = commands.add_parser('matrix', help='similarity of every pair of words in a list')
+    matrix.add_argument('input', help='file of words, one per line, or - for stdin')
+    matrix.add_argument('--output', help='write the full matrix to this .npy file')
+    matrix.add_argument('-k', type=int, default=10, help='otherwise output the k most similar words of each')
+    matrix.add_argument('--max-memory', type=float, default=256, help='megabytes used for the tiles')
 
-def search_bst(node, key):
+    recall = commands.add_parser('recall', help='recall@k of the LSH index against exact search')
+    recall.add_argument('-k', type=int, default=10)
+    recall.add_argument('--samples', type=int, default=100, help='random query words to compare')
+    recall.add_argument('--probes', type=int, default=2, help='extra buckets probed per table')
 
-    ascii2 = 1
-    temp = node
+    quantization = commands.add_parser('quantization',
+                                       help='error and memory of the --quantize mode (int8 by default)')
+    quantization.add_argument('--pairs', default='match_words.txt', help="file of 'word1 word2' lines to check")
 
-    for i in range(len(key)):
-        ascii2 = ascii2 * ord(key[i])
+    script = commands.add_parser('query', help='run a script of commands, one per line')
+    script.add_argument('script', nargs='?', default='-', help='script file, or - for stdin')
 
-    ascii2 = ascii2/len(key)
+    args = parser.parse_args(argv)
 
-    while temp is not None:
-        ascii1=1
+    if args.quantize and getattr(args, 'processes', 1) > 1:
+        parser.error('--quantize cannot be used with --processes, which share the vectors as float32')
 
-        for i in range(len(temp.key)):
-            ascii1 = ascii1 * ord(temp.key[i])
+    if args.quantize and args.lazy:
+        parser.error('--quantize cannot be used with --lazy, which keeps the vectors unparsed in the file')
 
-        ascii1 = ascii1/len(temp.key)
+    if args.command == 'similarity' and len(args.words) % 2:
+        parser.error('similarity takes pairs of words, got %d words' % len(args.words))
 
-        if temp.key == key:
-            return temp.code
+    if args.command == 'analogy' and len(args.words) % 3:
+        parser.error('analogy takes groups of three words, got %d words' % len(args.words))
 
-        elif ascii1 < ascii2:
-            temp = temp.right
+    if args.instrument:
+        enable_instrumentation()
 
-        else:
-            temp = temp.left
+    timings = {}
+    start = time.perf_counter()
 
+    with redirect_stdout(sys.stderr):
 
+        # build always parses the file, and refreshes the snapshot.
+        if args.command == 'build':
+            tree = openTree(args.embeddings, args.tree, args.bulk, args.workers, False,
+                            args.lazy, args.cache_size)
 
-def read_and_match(node):
+            if not args.no_snapshot and not args.lazy:
+                save_snapshot(tree, args.embeddings, args.tree)
 
-    with open('match_words.txt') as f:
+        else:
+            tree = openTree(args.embeddings, args.tree, args.bulk, args.workers, not args.no_snapshot,
+                            args.lazy, args.cache_size)
 
-        list = f.read().splitlines()
+        # The index is opened over the float32 vectors it is saved for, and
+        # quantize_tree moves it onto the quantized store.
+        if args.index or args.command == 'recall':
+            tree.index = openIndex(tree, args.embeddings, args.tree, not args.no_snapshot and not args.lazy)
 
-    for i in range(len(list)):
+        # quantization measures --quantize against the float32 vectors, so
+        # it keeps them.
+        if args.quantize and args.command != 'quantization':
+            quantize_tree(tree, args.quantize)
 
-        tempArray = list[i].split(' ')
-        word1 = search_bst(node, tempArray[0])
-        word2 = search_bst(node, tempArray[1])
-        word_sim = calculate_similarity(word1,word2)
+    timings['load_s'] = time.perf_counter() - start
 
-        print(tempArray[0]+' '+tempArray[1]+' '+str(word_sim))
+    if args.command == 'build':
+        command_list = [['count'], ['height']]
 
+    elif args.command in ('count', 'height'):
+        command_list = [[args.command]]
 
-def createAVL(list):
+    elif args.command == 'dump':
+        command_list = [['dump', args.output] + (['vectors'] if args.vectors else [])]
 
-    avl = AVLTree()
+    elif args.command == 'depth':
+        command_list = [['depth', str(args.depth)]]
 
-    for i in range(len(list)):
+    elif args.command == 'similarity':
+        words = args.words
 
-        tempArray = list[i].split(' ')
-        testWord = tempArray[0]
+        if args.input or not words:
+            command_list = [['similarity'] + command[:2] for command in read_commands(args.input or '-')]
+        else:
+            command_list = [['similarity', words[i], words[i + 1]] for i in range(0, len(words), 2)]
 
-        if testWord[0].isalpha():
-            newarray = []
+    elif args.command == 'nearest':
+        words = args.words
 
-            for j in range(len(tempArray)-1):
-                newarray.append(tempArray[j+1])
+        if args.input or not words:
+            words = [command[0] for command in read_commands(args.input or '-')]
 
-            node = Node(testWord, newarray)
-            avl.insert(node)
+        command_list = [['nearest', word, str(args.k)] for word in words]
 
-    nextStep(avl)
+    elif args.command == 'analogy':
+        words = args.words
+        command_list = [['analogy'] + words[i:i + 3] + [str(args.k)] for i in range(0, len(words), 3)]
 
+        if args.questions:
+            command_list.append(['analogies', args.questions])
 
-def createRedBlack(list):
+    elif args.command == 'matrix':
+        if args.output:
+            command_list = [['matrix', args.input, args.output, str(args.max_memory)]]
+        else:
+            command_list = [['topk', args.input, str(args.k), str(args.max_memory)]]
 
-    node = RedBlackTree()
+    elif args.command == 'quantization':
+        command_list = [['quantization', args.quantize or 'int8', args.pairs]]
 
-    for i in range(len(list)):
+    elif args.command == 'recall':
+        command_list = [['recall', str(args.k), str(args.samples), str(args.probes)]]
 
-        tempArray = list[i].split(' ')
-        testWord = tempArray[0]
+    else:
+        command_list = read_commands(args.script)
 
-        if testWord[0].isalpha():
-            newarray = []
+    start = time.perf_counter()
+    count = 0
 
-            for j in range(len(tempArray)-1):
-                newarray.append(tempArray[j+1])
-            node.insert(testWord, newarray)
+    processes = getattr(args, 'processes', 1)
+    cache = LookupCache(tree, args.cache_entries) if args.cache_entries > 0 else None
 
-    nextStep(node)
+    for result in execute_queries(tree, command_list, tree.index, processes, cache):
+        sys.stdout.write(json.dumps(result) + '\n')
+        count += 1
 
-def nextStep(node):#next step serves as a menu to continue after the Binary Search Tree is Created
+    timings['query_s'] = time.perf_counter() - start
+    timings['queries'] = count
+    timings['queries_per_s'] = count / timings['query_s'] if timings['query_s'] > 0 else None
 
-    print('What would you like to do? (Enter Number)')
-    print('1. Count the number of Nodes in BST ')
-    print('2. Get the height of BST')
-    print('3. Print BST to a file in ascending order')
-    print('4. Print BST at certain Depth into file')
-    print('5. Read Pair File and find similarity')
-    print('6. Exit')
-
-    answer = ''
-    answer = input(str('Enter Number: '))
-
-    if answer == 1:
-        number = numNodes(node.root)
-        print('Number of nodes in BST is: '+str(number))
-        print
-        nextStep(node)
-
-    elif answer == 2:
-        print(node.root.height)
-        nextStep(node)
-
-    elif answer == 3:
-        f = open("writeFile.txt", "w+")
-        pBST(node.root, f)
-        nextStep(node)
-
-    elif answer == 4:
-        f = open("writeFile.txt", "w+")
-        num = int(input(str('Enter Depth of tree you want to print: ')))
-        patdepth(node.root, f, num)
-        nextStep(node)
-
-    elif answer == 5:
-        read_and_match(node.root)
-
-    elif answer == 6:
-        print('goodbye')
-        return
+    sys.stdout.write(json.dumps({'op': 'timings', **timings}) + '\n')
 
-    else:
-        print('Invalid Input')
-        nextStep(node)
+    if cache is not None:
+        sys.stdout.write(json.dumps({'op': 'cache', **cache.stats()}) + '\n')
 
+    if STATS is not None:
+        sys.stdout.write(json.dumps({'op': 'instrumentation', **STATS.summary()}) + '\n')
+
+    if tree.scorer is not None:
+        tree.scorer.close()
 
-def main(list):#main caller to initiate if the Tree will be created as a AVL or Red Black Tree
-    answer = input(str('To use an AVL tree type 1 to use a Red Black Tree type 2: '))
-    i = 0
-    while i != 3:
-        if answer == 1:
-            createAVL(list)
-            break
-        elif answer ==  2:
-            createRedBlack(list)
-            break
-        else:
-            print('Invalid Answer')
-            answer = input(str('To use an AVL tree type 1 to use a Red Black Tree type 2: '))
-            i += 1
 
+if __name__ == '__main__':
+    if os.environ.get('LAB3_INSTRUMENT'):
+        enable_instrumentation()
 
-text1 = 'glove.6B.50d.txt'
-list = readFile(text1)
-main(list)
+    # With arguments, run the batch command line; without, the menu.
+    if len(sys.argv) > 1:
+        cli(sys.argv[1:])
+
+    else:
+        text1 = 'glove.6B.50d.txt'
+        main(text1)
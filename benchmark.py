@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Timing comparisons for the trees in Lab3.py.
+"""
+
+import argparse
+import json
+import string
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import Lab3
+
+
+# Node layouts from before __slots__ and the boolean color, kept only so the
+# memory benchmark has something to compare against.
+class DictNode:
+    def __init__(self, word, cd):
+        self.key = word
+        self.code = cd
+        self.parent = None
+        self.left = None
+        self.right = None
+        self.height = 0
+
+
+class DictRBTNode:
+    def __init__(self, key, cd, parent, is_red=False, left=None, right=None):
+        self.key = key
+        self.code = cd
+        self.left = left
+        self.right = right
+        self.parent = parent
+        self.height = 0
+
+        if is_red:
+            self.color = "red"
+
+        else:
+            self.color = "black"
+
+
+# Times building both tree types from the same pairs, once by inserting one
+# word at a time and once with bulk_load. The file is parsed up front so only
+# the tree construction is measured.
+def benchmark_build(filename):
+
+    pairs = list(Lab3.readFile(filename, report_every=0))
+    print('Building from %d words' % len(pairs))
+
+    for name, build in (('AVL', Lab3.buildAVL), ('Red-Black', Lab3.buildRedBlack)):
+
+        for label, bulk in (('incremental', False), ('bulk load', True)):
+            start = time.perf_counter()
+            tree = build(pairs, bulk)
+            elapsed = time.perf_counter() - start
+
+            print('%-10s %-12s %8.3fs  height %d' % (name, label, elapsed, tree.root.height))
+
+
+# Returns the bytes allocated per node when creating one node for each word.
+def node_bytes(make, words):
+
+    nodes = [None] * len(words)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    for i, word in enumerate(words):
+        nodes[i] = make(word, i)
+
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    return (after - before) / len(words)
+
+
+# Prints the memory used per word by each node layout, and the total per word
+# once the float32 vector row is added.
+def benchmark_memory(filename):
+
+    store = Lab3.buildAVL(Lab3.readFile(filename, report_every=0), True).store
+    words = store.words
+    vector = store.matrix.nbytes / len(words)
+
+    print('Memory per word over %d words (vector row: %.0f bytes)' % (len(words), vector))
+
+    layouts = (
+        ('AVL node, __dict__', lambda word, row: DictNode(word, row)),
+        ('AVL node, __slots__', lambda word, row: Lab3.Node(word, row)),
+        ('RB node, __dict__', lambda word, row: DictRBTNode(word, row, None)),
+        ('RB node, __slots__', lambda word, row: Lab3.RBTNode(word, row, None)),
+    )
+
+    for label, make in layouts:
+        size = node_bytes(make, words)
+        print('%-22s %6.0f bytes per node  %6.0f bytes per word' % (label, size, size + vector))
+
+
+# Prints the time per key of resolving batches of 10 to 1M words drawn from
+# the vocabulary, with one search_bst per word, with the sorted-merge
+# lookup_many, and with lookup_many's dictionary path.
+def benchmark_lookup(filename, seed=0):
+
+    tree = Lab3.buildAVL(Lab3.readFile(filename, report_every=0), True)
+    words = tree.store.words
+    rng = np.random.default_rng(seed)
+
+    # Build the dictionary up front so only lookups are timed.
+    tree.lookup_many([], use_dict=True)
+
+    print('%10s %14s %14s %14s' % ('batch', 'search_bst', 'lookup_many', 'dict'))
+
+    for size in (10, 100, 1000, 10000, 100000, 1000000):
+        batch = [words[i] for i in rng.integers(0, len(words), size)]
+
+        start = time.perf_counter()
+        for word in batch:
+            Lab3.search_bst(tree.root, word)
+        single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tree.lookup_many(batch)
+        merged = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tree.lookup_many(batch, use_dict=True)
+        hashed = time.perf_counter() - start
+
+        print('%10d %11.3f us %11.3f us %11.3f us'
+              % (size, 1e6 * single / size, 1e6 * merged / size, 1e6 * hashed / size))
+
+
+# Returns n distinct random lowercase words and an n x dim float32 matrix of
+# random vectors, standing in for an embedding file.
+def synthetic_vocabulary(n, dim, seed=0):
+
+    rng = np.random.default_rng(seed)
+    letters = np.array(list(string.ascii_lowercase))
+    words = set()
+
+    while len(words) < n:
+        for length in rng.integers(2, 12, n - len(words)):
+            words.add(''.join(rng.choice(letters, length)))
+
+    words = sorted(words)
+    rng.shuffle(words)
+
+    return words, rng.standard_normal((n, dim)).astype(np.float32)
+
+
+# Dictionary from word to row over an EmbeddingStore, the baseline the trees
+# are compared against.
+def build_dict(pairs):
+
+    store = Lab3.EmbeddingStore()
+    table = {}
+
+    for word, vector in pairs:
+        table[word] = store.add(word, vector)
+
+    store.trim()
+
+    return table, store
+
+
+# Returns the latency percentiles, in microseconds, of looking up each word
+# on its own.
+def lookup_latency(lookup, words):
+
+    times = np.empty(len(words))
+    clock = time.perf_counter_ns
+
+    for i, word in enumerate(words):
+        start = clock()
+        lookup(word)
+        times[i] = clock() - start
+
+    times /= 1000
+
+    return {'mean_us': float(times.mean()), 'p50_us': float(np.percentile(times, 50)),
+            'p90_us': float(np.percentile(times, 90)), 'p99_us': float(np.percentile(times, 99)),
+            'max_us': float(times.max())}
+
+
+# Returns the number of pairs per second scored by resolving both words of
+# every pair in one batch and calling batch_similarity once.
+def similarity_throughput(resolve, store, pairs):
+
+    start = time.perf_counter()
+    rows1 = resolve([word for word, _ in pairs])
+    rows2 = resolve([word for _, word in pairs])
+    Lab3.batch_similarity(store, rows1, rows2)
+    elapsed = time.perf_counter() - start
+
+    return len(pairs) / elapsed
+
+
+# Returns the seconds taken by build() and the peak bytes it allocates. The
+# build is run twice, since tracing allocations slows it down.
+def measure_build(build):
+
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+
+    del result
+    tracemalloc.start()
+    result = build()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return elapsed, peak, result
+
+
+# Runs every measurement on a synthetic vocabulary of n words with dim-wide
+# vectors for AVLTree, RedBlackTree and a plain dict, and returns the results
+# as a dict ready to be written out as JSON.
+def run_suite(n=100000, dim=50, queries=100000, seed=0):
+
+    words, matrix = synthetic_vocabulary(n, dim, seed)
+    rng = np.random.default_rng(seed + 1)
+
+    # Lookups are a mix of known words and words that are not in the tree.
+    known = [words[i] for i in rng.integers(0, n, queries)]
+    unknown = ['#' + word for word in known[:queries // 10]]
+    lookups = known + unknown
+    pairs = list(zip(known, [words[i] for i in rng.integers(0, n, queries)]))
+
+    results = {'words': n, 'dim': dim, 'queries': queries, 'seed': seed,
+               'python': sys.version.split()[0], 'numpy': np.__version__, 'structures': {}}
+
+    for name, build in (('AVLTree', Lab3.buildAVL), ('RedBlackTree', Lab3.buildRedBlack)):
+        entry = {}
+
+        for label, bulk in (('incremental', False), ('bulk', True)):
+            elapsed, peak, tree = measure_build(lambda: build(zip(words, matrix), bulk))
+            entry['build_' + label + '_s'] = elapsed
+            entry['peak_' + label + '_bytes'] = peak
+            entry['height_' + label] = tree.root.height
+
+        entry['lookup'] = lookup_latency(lambda word: Lab3.search_bst(tree.root, word), lookups)
+        entry['similarity_pairs_per_s'] = similarity_throughput(tree.lookup_many, tree.store, pairs)
+        results['structures'][name] = entry
+
+    elapsed, peak, (table, store) = measure_build(lambda: build_dict(zip(words, matrix)))
+    get = table.get
+    results['structures']['dict'] = {
+        'build_s': elapsed,
+        'peak_bytes': peak,
+        'lookup': lookup_latency(get, lookups),
+        'similarity_pairs_per_s': similarity_throughput(
+            lambda batch: np.array([get(word, -1) for word in batch], dtype=np.int64), store, pairs),
+    }
+
+    return results
+
+
+# Compares folding added words into a tree of n words against rebuilding the
+# whole tree, for each size in added. The added words come as their own tree
+# with their own store, as a shard built in another process would, so the
+# union also copies their vectors. Insertion one word at a time and a split
+# and join at the middle word are timed alongside. Returns the results as a
+# dict ready to be written out as JSON.
+def run_merge(n=100000, added=(1000, 10000, 100000), dim=50, seed=0):
+
+    words, matrix = synthetic_vocabulary(n + max(added), dim, seed)
+    results = {'words': n, 'dim': dim, 'seed': seed, 'structures': {}}
+
+    for name, build in (('AVLTree', Lab3.buildAVL), ('RedBlackTree', Lab3.buildRedBlack)):
+        entries = []
+
+        for m in added:
+            entry = {'added': m}
+
+            tree = build(zip(words[:n], matrix[:n]), True)
+            shard = build(zip(words[n:n + m], matrix[n:n + m]), True)
+            start = time.perf_counter()
+            tree.union(shard)
+            entry['union_s'] = time.perf_counter() - start
+            entry['height_union'] = tree.root.height
+
+            start = time.perf_counter()
+            build(zip(words[:n + m], matrix[:n + m]), True)
+            entry['rebuild_s'] = time.perf_counter() - start
+
+            tree = build(zip(words[:n], matrix[:n]), True)
+            start = time.perf_counter()
+            for word, vector in zip(words[n:n + m], matrix[n:n + m]):
+                row = tree.store.add(word, vector)
+                if name == 'AVLTree':
+                    tree.insert(Lab3.Node(word, row))
+                else:
+                    tree.insert(word, row)
+            entry['insert_s'] = time.perf_counter() - start
+
+            entries.append(entry)
+
+        tree = build(zip(words[:n], matrix[:n]), True)
+        key = tree.select(n // 2).key
+        start = time.perf_counter()
+        left, row, right = tree.split(key)
+        split = time.perf_counter() - start
+        start = time.perf_counter()
+        left.join(key, row, right)
+        joined = time.perf_counter() - start
+
+        results['structures'][name] = {'merge': entries, 'split_s': split, 'join_s': joined}
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the trees in Lab3.py.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    suite = commands.add_parser('suite', help='synthetic benchmark suite with JSON output')
+    suite.add_argument('--words', type=int, default=100000)
+    suite.add_argument('--dim', type=int, default=50)
+    suite.add_argument('--queries', type=int, default=100000)
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--output', help='write the JSON here instead of stdout')
+
+    merge = commands.add_parser('merge', help='union of added words against a rebuild, with JSON output')
+    merge.add_argument('--words', type=int, default=100000)
+    merge.add_argument('--added', type=int, nargs='+', default=[1000, 10000, 100000])
+    merge.add_argument('--dim', type=int, default=50)
+    merge.add_argument('--seed', type=int, default=0)
+    merge.add_argument('--output', help='write the JSON here instead of stdout')
+
+    glove = commands.add_parser('file', help='build, memory and lookup timings on an embedding file')
+    glove.add_argument('filename', nargs='?', default='glove.6B.50d.txt')
+
+    args = parser.parse_args()
+
+    if args.command in ('suite', 'merge'):
+        if args.command == 'suite':
+            report = json.dumps(run_suite(args.words, args.dim, args.queries, args.seed), indent=2)
+        else:
+            report = json.dumps(run_merge(args.words, args.added, args.dim, args.seed), indent=2)
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(report + '\n')
+        else:
+            print(report)
+
+    else:
+        benchmark_build(args.filename)
+        benchmark_memory(args.filename)
+        benchmark_lookup(args.filename)
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Long-running local query server for the trees in Lab3.py.
+"""
+
+import argparse
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import Lab3
+
+
+class SimilarityServer:
+    # Serves lookup, similarity and nearest requests over TCP or a Unix
+    # socket, one JSON object per line in each direction. The tree is loaded
+    # once. Requests from all connections go into one queue; a batcher takes
+    # up to max_batch of them, waiting at most max_wait seconds for more, and
+    # hands the batch to a worker thread, which answers it with one vectorized
+    # call per kind of request (NumPy releases the GIL while it multiplies).
+    # Up to workers batches run at once while the batcher keeps collecting
+    # the next ones. Replies go
+    # back on each connection in the order its requests arrived. Requests can
+    # carry an "id", which is copied into the reply. With cache_entries,
+    # similarity results go through a LookupCache of that many entries,
+    # shared by the workers under a lock.
+    def __init__(self, tree, max_batch=256, max_wait=0.002, workers=4, cache_entries=0):
+        self.tree = tree
+        self.cache = Lab3.LookupCache(tree, cache_entries) if cache_entries > 0 else None
+        self.cache_lock = threading.Lock()
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.running = set()
+        self.queue = None
+        self.connections = {}
+        self.latencies = deque(maxlen=100000)
+        self.served = 0
+        self.batches = 0
+        self.started = time.perf_counter()
+
+    async def start(self, host='127.0.0.1', port=8765, path=None):
+
+        self.queue = asyncio.Queue()
+        self.batcher = asyncio.ensure_future(self.run_batches())
+
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle, path=path)
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+
+        return self.server
+
+    async def stop(self):
+
+        self.server.close()
+
+        # Closing the listening socket leaves open connections alone, so
+        # close them too and let their handlers finish.
+        for writer in list(self.connections.values()):
+            writer.close()
+
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await self.server.wait_closed()
+        self.batcher.cancel()
+
+        for task in list(self.running):
+            task.cancel()
+
+        self.pool.shutdown(wait=False)
+
+    # Reads requests from one connection and queues them, while a second
+    # task writes the replies back in the same order.
+    async def handle(self, reader, writer):
+
+        replies = asyncio.Queue()
+        sender = asyncio.ensure_future(self.send_replies(replies, writer))
+        self.connections[asyncio.current_task()] = writer
+
+        try:
+            while True:
+                line = await reader.readline()
+
+                if not line:
+                    break
+
+                if not line.strip():
+                    continue
+
+                future = asyncio.get_running_loop().create_future()
+                await replies.put(future)
+
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    future.set_result({'error': 'invalid JSON'})
+                    continue
+
+                if not isinstance(request, dict):
+                    future.set_result({'error': 'request must be an object'})
+
+                elif request.get('op') == 'stats':
+                    future.set_result(self.stats())
+
+                else:
+                    await self.queue.put((request, future, time.perf_counter()))
+
+        except ConnectionError:
+            pass
+
+        finally:
+            await replies.put(None)
+            await sender
+            del self.connections[asyncio.current_task()]
+
+    async def send_replies(self, replies, writer):
+
+        try:
+            while True:
+                future = await replies.get()
+
+                if future is None:
+                    break
+
+                writer.write((json.dumps(await future) + '\n').encode('utf-8'))
+                await writer.drain()
+
+        except ConnectionError:
+            pass
+
+        finally:
+            writer.close()
+
+    # Collects queued requests into batches and starts a task answering each
+    # one, waiting only while workers batches are already running.
+    async def run_batches(self):
+
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.workers)
+
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+
+                if timeout <= 0 and self.queue.empty():
+                    break
+
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), max(timeout, 0)))
+                except asyncio.TimeoutError:
+                    break
+
+            await slots.acquire()
+            task = asyncio.ensure_future(self.run_batch(batch, slots))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    # Answers one batch on the worker pool and replies to its requests.
+    async def run_batch(self, batch, slots):
+
+        loop = asyncio.get_running_loop()
+
+        try:
+            try:
+                results = await loop.run_in_executor(self.pool, self.answer, [r for r, _, _ in batch])
+            except Exception as error:
+                results = [{'error': str(error)}] * len(batch)
+
+        finally:
+            slots.release()
+
+        now = time.perf_counter()
+        self.batches += 1
+
+        for (request, future, received), result in zip(batch, results):
+            self.latencies.append(now - received)
+            self.served += 1
+
+            if request.get('id') is not None:
+                result = dict(result, id=request['id'])
+
+            if not future.done():
+                future.set_result(result)
+
+    # Answers a batch of requests. Runs on a worker thread. Requests of the
+    # same kind are grouped so each kind costs one vectorized call. Each
+    # request is checked on its own, so a malformed one only gets an error
+    # back itself.
+    def answer(self, requests):
+
+        results = [None] * len(requests)
+        lookups = []
+        pairs = []
+        nearest = {}
+
+        for i, request in enumerate(requests):
+            op = request.get('op')
+
+            if op == 'lookup' and isinstance(request.get('word'), str):
+                lookups.append(i)
+
+            elif op == 'similarity' and isinstance(request.get('word1'), str) and isinstance(request.get('word2'), str):
+                pairs.append(i)
+
+            elif (op == 'nearest' and isinstance(request.get('word'), str) and
+                  type(request.get('k', 10)) is int and request.get('k', 10) >= 0):
+                nearest.setdefault(request.get('k', 10), []).append(i)
+
+            else:
+                results[i] = {'op': op, 'error': 'unknown or malformed request'}
+
+        if lookups:
+            rows = self.tree.lookup_many([requests[i]['word'] for i in lookups], use_dict=True)
+
+            for i, row in zip(lookups, rows.tolist()):
+                results[i] = {'op': 'lookup', 'word': requests[i]['word'], 'found': row >= 0,
+                              'row': row if row >= 0 else None}
+
+        if pairs:
+            batch = [(requests[i]['word1'], requests[i]['word2']) for i in pairs]
+            if self.cache is not None:
+                with self.cache_lock:
+                    scores, missing = Lab3.score_pairs(self.tree, batch, cache=self.cache)
+            else:
+                scores, missing = Lab3.score_pairs(self.tree, batch)
+
+            for i, (word1, word2), score, absent in zip(pairs, batch, scores, missing):
+                results[i] = {'op': 'similarity', 'word1': word1, 'word2': word2,
+                              'similarity': score, 'missing': absent}
+
+        for k, group in nearest.items():
+            words = [requests[i]['word'] for i in group]
+            found = Lab3.nearest(self.tree, words, k, index=self.tree.index)
+
+            for i, word, best in zip(group, words, found):
+                results[i] = {'op': 'nearest', 'word': word, 'k': k, 'missing': best is None,
+                              'neighbours': best or []}
+
+        return results
+
+    # Latency percentiles over the most recent requests, and throughput since
+    # the server started.
+    def stats(self):
+
+        latencies = np.array(self.latencies) * 1000
+        elapsed = time.perf_counter() - self.started
+        result = {'op': 'stats', 'served': self.served, 'batches': self.batches,
+                  'requests_per_s': self.served / elapsed if elapsed > 0 else 0.0}
+
+        if len(latencies):
+            result.update({'p50_ms': float(np.percentile(latencies, 50)),
+                           'p90_ms': float(np.percentile(latencies, 90)),
+                           'p99_ms': float(np.percentile(latencies, 99)),
+                           'max_ms': float(latencies.max())})
+
+        if self.cache is not None:
+            result['cache'] = self.cache.stats()
+
+        return result
+
+
+# Sends requests to a running server on one connection and returns the
+# replies in the same order. Meant for tests and scripts on localhost.
+async def send_requests(requests, host='127.0.0.1', port=8765, path=None):
+
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+
+    writer.write(''.join(json.dumps(request) + '\n' for request in requests).encode('utf-8'))
+    await writer.drain()
+
+    replies = []
+
+    for _ in requests:
+        replies.append(json.loads(await reader.readline()))
+
+    writer.close()
+    await writer.wait_closed()
+
+    return replies
+
+
+def request(requests, host='127.0.0.1', port=8765, path=None):
+
+    return asyncio.run(send_requests(requests, host, port, path))
+
+
+async def serve(tree, args):
+
+    server = SimilarityServer(tree, args.max_batch, args.max_wait, args.threads, args.cache_entries)
+    await server.start(args.host, args.port, args.unix)
+
+    if args.unix:
+        print('Serving on ' + args.unix)
+    else:
+        print('Serving on %s:%d' % (args.host, args.port))
+
+    async with server.server:
+        await server.server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local similarity query server.')
+    parser.add_argument('--embeddings', default='glove.6B.50d.txt')
+    parser.add_argument('--tree', choices=('avl', 'rb'), default='avl')
+    parser.add_argument('--bulk', action='store_true')
+    parser.add_argument('--workers', type=int, default=1, help='processes used to parse the embedding file')
+    parser.add_argument('--index', action='store_true', help='answer nearest requests with an LSH index')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', help='listen on this Unix socket path instead of TCP')
+    parser.add_argument('--threads', type=int, default=4, help='worker threads answering batches')
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-wait', type=float, default=0.002, help='seconds to wait to fill a batch')
+    parser.add_argument('--cache-entries', type=int, default=0,
+                        help='keep this many recent similarity results in an LRU cache')
+    args = parser.parse_args()
+
+    tree = Lab3.openTree(args.embeddings, args.tree, args.bulk, args.workers)
+
+    if args.index:
+        tree.index = Lab3.openIndex(tree, args.embeddings, args.tree)
+
+    asyncio.run(serve(tree, args))